@@ -0,0 +1,423 @@
+"""Offline benchmarks for bot.py against an in-process fake TelegramClient.
+
+Reports scheduler throughput, per-command handler latency, storage flush cost
+versus dataset size and peak RSS as JSON, for tracking regressions:
+
+    python benchmark.py --output results.json
+    python benchmark.py --sizes 1000,10000 --latency 0.005 --flood-rate 0.01
+
+Bot settings can be overridden through the usual environment variables. The
+forward rate limits default to effectively unlimited here so the scheduler is
+measured rather than Telegram's limits.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import zlib
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+os.environ.setdefault('GLOBAL_FORWARD_RATE', '1000000000')
+os.environ.setdefault('CHAT_FORWARD_RATE', '1000000000')
+
+# bot.py creates its log file in the working directory on import
+LAUNCH_DIR = os.getcwd()
+WORKDIR = tempfile.mkdtemp(prefix='forwarder-bench-')
+os.chdir(WORKDIR)
+
+import bot
+from telethon.errors import FloodWaitError
+from telethon.tl import types
+from telethon.tl.functions.channels import GetParticipantRequest, JoinChannelRequest
+from telethon.tl.functions.messages import CheckChatInviteRequest, ImportChatInviteRequest
+
+# ==================== FAKE TELEGRAM CLIENT ====================
+class FakeEntity:
+    """User, chat or channel as returned by get_me/get_entity"""
+
+    def __init__(self, entity_id: int, title: str = None, username: str = None):
+        self.id = entity_id
+        self.title = title
+        self.username = username
+        self.first_name = title
+
+
+class FakeMessage:
+    """Message carrying the attributes PrivateChatOnlyBot reads"""
+
+    def __init__(self, message_id: int, text: str = ''):
+        self.id = message_id
+        self.text = text
+        self.message = text
+        self.media = None
+        self.forward = None
+        self.entities = None
+        self.grouped_id = None
+        self.date = datetime.now()
+
+    async def edit(self, *args, **kwargs):
+        return self
+
+    async def reply(self, *args, **kwargs):
+        return FakeMessage(0)
+
+
+class FakeUpdates:
+    """Result of ImportChatInviteRequest"""
+
+    def __init__(self, chat_id: int):
+        self.updates = [types.UpdateChat(chat_id=chat_id)]
+
+
+class FakeTelegramClient:
+    """In-process stand-in for the TelegramClient surface PrivateChatOnlyBot uses"""
+
+    def __init__(self, latency: float = 0.0, flood_rate: float = 0.0,
+                 flood_seconds: int = 1, seed: int = 0):
+        # Every RPC sleeps latency seconds; forward_messages raises
+        # FloodWaitError(flood_seconds) with probability flood_rate
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.random = random.Random(seed)
+        self.handlers = []
+        self.calls = Counter()
+        self.forwarded = 0
+        self.flood_waits = 0
+        self._disconnected = asyncio.Event()
+        self._next_message_id = 1
+
+    async def _rpc(self, name: str):
+        """Account for one request and simulate its round trip"""
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def start(self, bot_token: str = None):
+        self._disconnected.clear()
+        return self
+
+    def is_connected(self) -> bool:
+        return not self._disconnected.is_set()
+
+    async def disconnect(self):
+        self._disconnected.set()
+
+    async def run_until_disconnected(self):
+        await self._disconnected.wait()
+
+    def add_event_handler(self, callback, event=None):
+        self.handlers.append((callback, event))
+
+    async def get_me(self):
+        await self._rpc('get_me')
+        return FakeEntity(1, 'Benchmark Bot', 'benchmark_bot')
+
+    async def get_entity(self, peer):
+        await self._rpc('get_entity')
+        if isinstance(peer, int):
+            return FakeEntity(abs(peer), f"Chat {abs(peer)}")
+        return FakeEntity(zlib.crc32(peer.encode()), f"Group {peer}", peer)
+
+    async def get_messages(self, entity, ids=None, **kwargs):
+        await self._rpc('get_messages')
+        if isinstance(ids, list):
+            return [FakeMessage(message_id) for message_id in ids]
+        return FakeMessage(ids or 0)
+
+    async def forward_messages(self, entity, messages, from_peer=None, **kwargs):
+        await self._rpc('forward_messages')
+        if self.flood_rate and self.random.random() < self.flood_rate:
+            self.flood_waits += 1
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+
+        single = not isinstance(messages, list)
+        messages = [messages] if single else messages
+        self.forwarded += len(messages)
+        forwarded = []
+        for _ in messages:
+            forwarded.append(FakeMessage(self._next_message_id))
+            self._next_message_id += 1
+        return forwarded[0] if single else forwarded
+
+    async def __call__(self, request):
+        await self._rpc(type(request).__name__)
+        if isinstance(request, CheckChatInviteRequest):
+            chat_id = zlib.crc32(request.hash.encode())
+            return types.ChatInviteAlready(chat=FakeEntity(chat_id, f"Private {request.hash}"))
+        if isinstance(request, ImportChatInviteRequest):
+            return FakeUpdates(zlib.crc32(request.hash.encode()))
+        if isinstance(request, (GetParticipantRequest, JoinChannelRequest)):
+            return None
+        raise NotImplementedError(f"FakeTelegramClient does not handle {type(request).__name__}")
+
+
+class FakeEvent:
+    """NewMessage/CallbackQuery event from a private chat"""
+
+    def __init__(self, sender_id: int, raw_text: str = '', message: FakeMessage = None,
+                 data: bytes = b''):
+        self.sender_id = sender_id
+        self.raw_text = raw_text
+        self.message = message or FakeMessage(0, raw_text)
+        self.data = data
+        self.is_private = True
+
+    async def reply(self, *args, **kwargs):
+        return FakeMessage(0)
+
+    async def edit(self, *args, **kwargs):
+        return self.message
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def delete(self):
+        pass
+
+# ==================== HELPERS ====================
+@contextlib.contextmanager
+def fresh_directory(name: str):
+    """Run a benchmark in its own directory so storage files start empty"""
+    path = os.path.join(WORKDIR, name)
+    os.makedirs(path, exist_ok=True)
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(previous)
+
+
+def peak_rss_kb():
+    """Peak resident set size of this process in KiB"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux KiB
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Latency summary in milliseconds"""
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'mean_ms': statistics.fmean(ordered) * 1000,
+        'p50_ms': ordered[len(ordered) // 2] * 1000,
+        'p95_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+def make_bot(client: FakeTelegramClient, **options) -> 'bot.PrivateChatOnlyBot':
+    """PrivateChatOnlyBot wired to a fake client"""
+    return bot.PrivateChatOnlyBot(bot.API_ID, bot.API_HASH, bot.BOT_TOKEN, client=client, **options)
+
+# ==================== BENCHMARKS ====================
+async def bench_scheduler(size: int, args) -> dict:
+    """Time for the scheduler to forward size due tasks once"""
+    client = FakeTelegramClient(args.latency, args.flood_rate, args.flood_seconds, args.seed)
+    forwarder = make_bot(client)
+
+    started = time.perf_counter()
+    tasks = []
+    for i in range(size):
+        # Ten targets per user sharing one source message, as a multi-target setup creates
+        user_id = 100000 + i // 10
+        task_data = {
+            'user_id': user_id,
+            'target_chat_id': 1000000 + i,
+            'target_chat_title': f"Chat {i}",
+            'source_msg_id': user_id,
+            'interval': 1,
+            'status': 'active'
+        }
+        forwarder.tasks.create(user_id, task_data)
+        tasks.append((user_id, task_data, 0))
+    setup_seconds = time.perf_counter() - started
+
+    flusher = asyncio.create_task(forwarder.data_manager.run_flusher())
+    forwarder.scheduler.start()
+    started = time.perf_counter()
+    forwarder.scheduler.add_many(tasks)
+    deadline = started + args.timeout
+    while client.forwarded < size and time.perf_counter() < deadline:
+        await asyncio.sleep(0.005)
+    elapsed = time.perf_counter() - started
+
+    forwarder.scheduler.stop()
+    flusher.cancel()
+    forwarder.data_manager.flush()
+    forwarder.data_manager.close()
+    return {
+        'tasks': size,
+        'forwarded': client.forwarded,
+        'completed': client.forwarded >= size,
+        'setup_seconds': setup_seconds,
+        'seconds': elapsed,
+        'forwards_per_second': client.forwarded / elapsed if elapsed else None,
+        'forward_requests': client.calls['forward_messages'],
+        'flood_waits': client.flood_waits,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+
+async def bench_handlers(args) -> dict:
+    """Per-command latency over complete setup flows of many users"""
+    client = FakeTelegramClient(args.latency, 0.0, args.flood_seconds, args.seed)
+    forwarder = make_bot(client)
+    samples: Dict[str, List[float]] = {}
+
+    async def timed(name: str, handler, event: FakeEvent):
+        started = time.perf_counter()
+        await handler(event)
+        samples.setdefault(name, []).append(time.perf_counter() - started)
+
+    for n in range(args.handler_users):
+        user_id = 500000 + n
+        groups = ' '.join(f"t.me/bench_group_{(n + k) % 50}" for k in range(args.targets))
+        await timed('/start', forwarder.handle_start, FakeEvent(user_id, '/start'))
+        await timed('setup_targets', forwarder.handle_message, FakeEvent(user_id, groups))
+        await timed('setup_message', forwarder.handle_message,
+                    FakeEvent(user_id, message=FakeMessage(n + 1, f"Benchmark message {n}")))
+        await timed('setup_interval', forwarder.handle_callback, FakeEvent(user_id, data=b'int_1'))
+        await timed('/mytasks', forwarder.handle_my_tasks, FakeEvent(user_id, '/mytasks'))
+        await timed('/status', forwarder.handle_status, FakeEvent(user_id, '/status'))
+        await timed('/help', forwarder.handle_help, FakeEvent(user_id, '/help'))
+        await timed('/stoptask', forwarder.handle_stop_task, FakeEvent(user_id, '/stoptask_1'))
+        await timed('/cancel', forwarder.handle_cancel, FakeEvent(user_id, '/cancel'))
+
+    forwarder.scheduler.stop()
+    forwarder.data_manager.flush()
+    forwarder.data_manager.close()
+    return {
+        'users': args.handler_users,
+        'targets_per_setup': args.targets,
+        'commands': {name: summarize(values) for name, values in samples.items()},
+        'rpc_calls': dict(client.calls),
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+
+def bench_storage(backend: str, size: int, args) -> dict:
+    """Cost of save_data() and the flush that follows it at a dataset size"""
+    data_manager = bot.create_data_manager(backend)
+    for i in range(size):
+        user_id = 100000 + i // 10
+        data_manager.add_forwarding_task(user_id, {
+            'user_id': user_id,
+            'target_chat_id': 1000000 + i,
+            'target_chat_title': f"Chat {i}",
+            'source_msg_id': user_id,
+            'interval': 1,
+            'status': 'active'
+        })
+    data_manager.flush()
+
+    mark, flush = [], []
+    for _ in range(args.storage_rounds):
+        i = random.randrange(size)
+        started = time.perf_counter()
+        # update_task_last_forward() is what every forward does and ends in save_data()
+        data_manager.update_task_last_forward(100000 + i // 10, i % 10 + 1)
+        mark.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        data_manager.flush()
+        flush.append(time.perf_counter() - started)
+
+    data_manager.close()
+    files = {name: os.path.getsize(name) for name in os.listdir('.') if name.startswith('forwarder_data')}
+    return {
+        'backend': backend,
+        'mode': bot.STORAGE_MODE if backend == 'json' else None,
+        'tasks': size,
+        'save_data': summarize(mark),
+        'flush': summarize(flush),
+        'file_bytes': files,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+# ==================== MAIN ====================
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the forwarder bot")
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help="comma-separated task counts for the scheduler and storage benchmarks")
+    parser.add_argument('--latency', type=float, default=0.0, help="fake RPC latency in seconds")
+    parser.add_argument('--flood-rate', type=float, default=0.0,
+                        help="probability that a forward raises FloodWaitError")
+    parser.add_argument('--flood-seconds', type=int, default=1, help="seconds in injected flood waits")
+    parser.add_argument('--handler-users', type=int, default=200, help="setup flows in the handler benchmark")
+    parser.add_argument('--targets', type=int, default=3, help="targets per setup in the handler benchmark")
+    parser.add_argument('--storage', default='json,sqlite', help="storage backends to benchmark")
+    parser.add_argument('--storage-rounds', type=int, default=20, help="flushes timed per storage size")
+    parser.add_argument('--timeout', type=float, default=600, help="give up on a scheduler run after this long")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log-level', default='WARNING', help="bot log level while benchmarking")
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    return parser.parse_args(argv)
+
+
+async def run(args) -> dict:
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    results = {
+        'started_at': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': vars(args),
+        'scheduler': [],
+        'handlers': None,
+        'storage': [],
+    }
+
+    for size in sizes:
+        print(f"⏱️ Scheduler: {size} tasks", file=sys.stderr)
+        with fresh_directory(f"scheduler-{size}"):
+            results['scheduler'].append(await bench_scheduler(size, args))
+
+    print(f"⏱️ Handlers: {args.handler_users} users", file=sys.stderr)
+    with fresh_directory('handlers'):
+        results['handlers'] = await bench_handlers(args)
+
+    for backend in args.storage.split(','):
+        for size in sizes:
+            print(f"⏱️ Storage: {backend}, {size} tasks", file=sys.stderr)
+            with fresh_directory(f"storage-{backend}-{size}"):
+                results['storage'].append(bench_storage(backend, size, args))
+
+    results['peak_rss_kb'] = peak_rss_kb()
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    logging.getLogger().setLevel(args.log_level)
+
+    results = asyncio.run(run(args))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(os.path.join(LAUNCH_DIR, args.output), 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+        print(f"✅ Results written to {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
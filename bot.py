@@ -1,13 +1,34 @@
+import time
+
+# Startup timing begins before the heavier imports below
+IMPORT_STARTED = time.perf_counter()
+
 import asyncio
+import atexit
+import bisect
+import cProfile
+import heapq
+import html
+import itertools
 import json
 import logging
+import multiprocessing
+import queue
 import re
 import os
+import pstats
+import signal
+import random
+import sqlite3
+import threading
+from collections import OrderedDict, defaultdict
+from http import HTTPStatus
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
 
-from telethon import TelegramClient, events, Button
+from telethon import TelegramClient, events, Button, utils
 from telethon.tl import types
 from telethon.tl.functions.channels import (
     GetParticipantRequest, 
@@ -27,7 +48,8 @@ from telethon.errors import (
     InviteHashInvalidError,
     InviteRequestSentError, 
     UserAlreadyParticipantError,
-    ChannelsTooMuchError
+    ChannelsTooMuchError,
+    MessageIdInvalidError
 )
 
 # ==================== CONFIGURATION ====================
@@ -37,144 +59,2296 @@ BOT_TOKEN = os.environ.get('BOT_TOKEN', '8269695320:AAFVvdG5tSjavOcFSusKTg6Y0iUe
 
 # Storage files
 DATA_FILE = 'forwarder_data.json'
+JOURNAL_FILE = 'forwarder_data.journal'
+MESSAGES_FILE = 'forwarder_messages.jsonl'
+SQLITE_FILE = 'forwarder_data.db'
 LOG_FILE = 'forwarder_bot.log'
+LEDGER_FILE = 'forward_ledger.jsonl'
 SESSION_FILE = 'forwarder_bot.session'
 
+# Logging runs through a queue so file writes happen on a listener thread.
+# LOG_ROTATE is 'size' (LOG_MAX_BYTES per file) or 'time' (daily), keeping
+# LOG_BACKUPS old files. LOG_FORMAT 'json' writes one JSON object per line.
+# LOG_SAMPLE_RATE is the fraction of per-forward and ignored-message INFO
+# lines kept; warnings and errors are always logged.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_ROTATE = os.environ.get('LOG_ROTATE', 'size')
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.environ.get('LOG_BACKUPS', '5'))
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '1'))
+
+# Forward ledger: every forward attempt is appended to LEDGER_FILE as one JSON line,
+# written every LEDGER_FLUSH_INTERVAL seconds and rotated at LEDGER_MAX_BYTES
+LEDGER_FLUSH_INTERVAL = float(os.environ.get('LEDGER_FLUSH_INTERVAL', '5'))
+LEDGER_MAX_BYTES = int(os.environ.get('LEDGER_MAX_BYTES', str(10 * 1024 * 1024)))
+LEDGER_BACKUPS = int(os.environ.get('LEDGER_BACKUPS', '5'))
+
+# Storage backend: 'json' (DATA_FILE) or 'sqlite' (SQLITE_FILE)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json')
+
+# JSON storage mode: 'journal' appends one record per change and compacts in the
+# background, 'snapshot' rewrites DATA_FILE on flush. Snapshots are serialized on
+# the event loop (only the write is in the background), so snapshot mode costs
+# O(total data) on the loop every flush; journal mode pays that only when compacting.
+STORAGE_MODE = os.environ.get('STORAGE_MODE', 'journal')
+JOURNAL_COMPACT_THRESHOLD = int(os.environ.get('JOURNAL_COMPACT_THRESHOLD', '1000'))
+# MESSAGES_FILE is pruned of records no task or setup uses once it holds this many
+# records, or twice as many as after the previous pruning
+MESSAGES_PRUNE_THRESHOLD = int(os.environ.get('MESSAGES_PRUNE_THRESHOLD', '1000'))
+
+# Write-behind: changes are flushed every SAVE_INTERVAL seconds,
+# or sooner once SAVE_BATCH_SIZE changes are pending
+SAVE_INTERVAL = float(os.environ.get('SAVE_INTERVAL', '5'))
+SAVE_BATCH_SIZE = int(os.environ.get('SAVE_BATCH_SIZE', '100'))
+
+# Forwarding: number of concurrent forward workers fed by the scheduler
+FORWARD_WORKERS = int(os.environ.get('FORWARD_WORKERS', '8'))
+
+# Tasks due within this many seconds of each other that share a source chat and
+# target are sent as one forwardMessages request of at most FORWARD_BATCH_SIZE IDs,
+# and no more than ForwardRateLimiter.CHAT_BURST so one request fits a chat's bucket
+FORWARD_COALESCE_WINDOW = float(os.environ.get('FORWARD_COALESCE_WINDOW', '1'))
+FORWARD_BATCH_SIZE = 100
+
+# Rate limits in forwards per second; Telegram allows bots about 30 messages/s
+# overall and 20/min per group. Flood waits and rate-limit waits up to
+# FLOOD_WAIT_INLINE_MAX seconds are waited out by the worker, longer ones are rescheduled.
+GLOBAL_FORWARD_RATE = float(os.environ.get('GLOBAL_FORWARD_RATE', '25'))
+CHAT_FORWARD_RATE = float(os.environ.get('CHAT_FORWARD_RATE', '0.33'))
+FLOOD_WAIT_INLINE_MAX = float(os.environ.get('FLOOD_WAIT_INLINE_MAX', '30'))
+FLOOD_WAIT_RETRIES = int(os.environ.get('FLOOD_WAIT_RETRIES', '3'))
+
+# Source messages kept in memory so forwards don't need to refetch them
+SOURCE_CACHE_SIZE = int(os.environ.get('SOURCE_CACHE_SIZE', '1024'))
+
+# Restore: overdue tasks are released at RESTORE_RATE per second after a restart,
+# each with up to RESTORE_JITTER seconds of random delay. Restore runs in the
+# background in chunks of RESTORE_CHUNK_SIZE so updates are handled meanwhile.
+RESTORE_RATE = float(os.environ.get('RESTORE_RATE', '5'))
+RESTORE_JITTER = float(os.environ.get('RESTORE_JITTER', '2'))
+RESTORE_CHUNK_SIZE = 500
+
+# Per-user limits: plain messages closer together than REPEAT_WINDOW seconds are
+# ignored, commands are limited to COMMAND_RATE per second with COMMAND_BURST burst
+REPEAT_WINDOW = float(os.environ.get('REPEAT_WINDOW', '2'))
+COMMAND_RATE = float(os.environ.get('COMMAND_RATE', '0.5'))
+COMMAND_BURST = float(os.environ.get('COMMAND_BURST', '5'))
+
+# Setup: group references accepted per setup message, and how many are verified at once
+MAX_SETUP_TARGETS = int(os.environ.get('MAX_SETUP_TARGETS', '50'))
+VERIFY_CONCURRENCY = int(os.environ.get('VERIFY_CONCURRENCY', '5'))
+
+# Albums arrive as one message per item sharing a grouped_id; during setup the items
+# are collected until none has arrived for ALBUM_COLLECT_WINDOW seconds
+ALBUM_COLLECT_WINDOW = float(os.environ.get('ALBUM_COLLECT_WINDOW', '1'))
+
+# Captured source message records kept in memory; the rest are read back from storage
+MESSAGE_STORE_SIZE = int(os.environ.get('MESSAGE_STORE_SIZE', '2048'))
+
+# Setup conversations live in memory and are dropped after their step's TTL in
+# seconds without progress; CONVERSATION_PERSIST=1 also keeps them in storage so
+# they survive restarts
+CONVERSATION_TTL = float(os.environ.get('CONVERSATION_TTL', '900'))
+CONVERSATION_STEP_TTLS = {
+    'awaiting_group': CONVERSATION_TTL,
+    'awaiting_message': CONVERSATION_TTL,
+    # The user has already verified targets and sent the message here
+    'awaiting_interval': CONVERSATION_TTL * 2,
+}
+CONVERSATION_SWEEP_INTERVAL = 60
+CONVERSATION_PERSIST = os.environ.get('CONVERSATION_PERSIST', '0') == '1'
+
+# Resolved usernames, IDs, invites and membership checks are reused for this long
+RESOLVE_CACHE_TTL = float(os.environ.get('RESOLVE_CACHE_TTL', '300'))
+RESOLVE_CACHE_SIZE = int(os.environ.get('RESOLVE_CACHE_SIZE', '4096'))
+
+# Sharded mode: with SHARD_WORKERS > 0 this process only handles chats and
+# SHARD_WORKERS worker processes forward the tasks, each owning a hash partition.
+# Requires STORAGE_BACKEND=sqlite. Workers heartbeat every SHARD_SYNC_INTERVAL
+# seconds and are dropped from the partition after SHARD_HEARTBEAT_TIMEOUT.
+SHARD_WORKERS = int(os.environ.get('SHARD_WORKERS', '0'))
+SHARD_SYNC_INTERVAL = float(os.environ.get('SHARD_SYNC_INTERVAL', '5'))
+SHARD_HEARTBEAT_TIMEOUT = float(os.environ.get('SHARD_HEARTBEAT_TIMEOUT', '20'))
+
+# Inbound updates are handled on INBOUND_LANES concurrent lanes chosen by sender, so
+# one user's updates stay in order while a slow one doesn't hold up other users. A
+# lane holds INBOUND_QUEUE_SIZE waiting updates; beyond that new updates wait for room.
+INBOUND_LANES = int(os.environ.get('INBOUND_LANES', '16'))
+INBOUND_QUEUE_SIZE = int(os.environ.get('INBOUND_QUEUE_SIZE', '100'))
+
+# Handler calls and forward batches taking longer than this many seconds are logged
+SLOW_CALL_THRESHOLD = float(os.environ.get('SLOW_CALL_THRESHOLD', '1'))
+
+# Profiling: users in ADMIN_IDS (comma-separated) may run /profile N, and PROFILE=N
+# profiles the first N seconds after startup; results are written to PROFILE_DIR
+ADMIN_IDS = {int(user_id) for user_id in os.environ.get('ADMIN_IDS', '').split(',') if user_id.strip()}
+PROFILE_SECONDS = float(os.environ.get('PROFILE', '0'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_MAX_SECONDS = 600
+
+# How often the bot publishes its status snapshot for the web interface
+STATUS_INTERVAL = float(os.environ.get('STATUS_INTERVAL', '5'))
+
+# Web interface: 'flask' runs Flask's server in a thread, 'async' serves the same
+# routes from the bot's event loop, 'off' disables it
+WEB_MODE = os.environ.get('WEB_MODE', 'flask')
+WEB_PORT = int(os.environ.get('PORT', 5000))
+# Shard worker N serves its own /metrics on WORKER_METRICS_PORT + N; the front
+# process forwards nothing, so its /metrics leaves out the forwarding figures
+WORKER_METRICS_PORT = int(os.environ.get('WORKER_METRICS_PORT', WEB_PORT + 1))
+
 # ==================== SETUP LOGGING ====================
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE, encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+class JsonFormatter(logging.Formatter):
+    """One compact JSON object per line, with context fields passed through extra="""
+    
+    CONTEXT_FIELDS = ('user_id', 'task_id', 'chat_id')
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in self.CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        return json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps one in every 1/rate records below WARNING"""
+    
+    def __init__(self, rate: float):
+        super().__init__()
+        self.every = max(1, round(1 / rate)) if rate > 0 else 0
+        self._seen = itertools.count()
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        return bool(self.every) and next(self._seen) % self.every == 0
+
+
+_log_listener: Optional[QueueListener] = None
+
+
+def setup_logging(log_file: str = LOG_FILE):
+    """Send all records through a queue to rotating file and console handlers"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+    
+    if LOG_FORMAT == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if LOG_ROTATE == 'time':
+        file_handler = TimedRotatingFileHandler(log_file, when='midnight', backupCount=LOG_BACKUPS, encoding='utf-8')
+    else:
+        file_handler = RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8')
+    handlers = (file_handler, logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    # The event loop only enqueues; the listener thread formats and writes
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(LOG_LEVEL)
+    _log_listener = QueueListener(log_queue, *handlers)
+    _log_listener.start()
+
+
+def stop_logging():
+    """Drain the log queue; registered with atexit"""
+    if _log_listener is not None:
+        _log_listener.stop()
+
+
+setup_logging()
+atexit.register(stop_logging)
 logger = logging.getLogger(__name__)
 
-# ==================== DATA MANAGEMENT ====================
-class DataManager:
-    """Manages local storage for bot data"""
+# High-volume lines get their own loggers so they can be sampled
+forward_logger = logger.getChild('forward')
+filter_logger = logger.getChild('filter')
+if LOG_SAMPLE_RATE < 1:
+    forward_logger.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+    filter_logger.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+
+# ==================== METRICS ====================
+class Metric:
+    """Base for metrics rendered in the Prometheus text exposition format"""
+    
+    kind = 'untyped'
+    
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+    
+    @staticmethod
+    def _escape(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    
+    def _labels(self, labels: tuple, extra: str = '') -> str:
+        pairs = [f'{name}="{self._escape(value)}"' for name, value in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+    
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+    
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """Monotonically increasing value per label set"""
+    
+    kind = 'counter'
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[tuple, float] = defaultdict(float)
+        if not self.labelnames:
+            self.values[()] = 0
+    
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] += amount
+    
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._labels(labels)} {value}" for labels, value in list(self.values.items())]
+
+
+class Gauge(Metric):
+    """Value that can go up and down"""
+    
+    kind = 'gauge'
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[tuple, float] = {}
+        if not self.labelnames:
+            self.values[()] = 0
+    
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+    
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._labels(labels)} {value}" for labels, value in list(self.values.items())]
+
+
+class Histogram(Metric):
+    """Bucketed distribution; observe() is a bisect and two increments"""
+    
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    
+    def __init__(self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        self.counts: Dict[tuple, List[int]] = {}
+        self.sums: Dict[tuple, float] = defaultdict(float)
+    
+    def observe(self, value: float, *labels):
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+    
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, counts in list(self.counts.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                bucket_label = f'le="{le}"'
+                lines.append(f"{self.name}_bucket{self._labels(labels, bucket_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(labels)} {self.sums[labels]}")
+            lines.append(f"{self.name}_count{self._labels(labels)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Collection of metrics exposed on /metrics"""
+    
+    def __init__(self):
+        self.metrics: List[Metric] = []
+    
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+    
+    def render(self, exclude: Tuple[Metric, ...] = ()) -> str:
+        return '\n'.join(metric.render() for metric in self.metrics if metric not in exclude) + '\n'
+
+
+METRICS = MetricsRegistry()
+FORWARD_LATENCY = METRICS.register(Histogram(
+    'forwarder_forward_latency_seconds', 'Latency of forwardMessages requests'))
+FORWARD_RESULTS = METRICS.register(Counter(
+    'forwarder_forwards_total', 'Task forwards by outcome or error class', ('outcome',)))
+FLOOD_WAITS = METRICS.register(Counter(
+    'forwarder_flood_waits_total', 'FloodWaitError responses on the forward path'))
+FLOOD_WAIT_SECONDS = METRICS.register(Counter(
+    'forwarder_flood_wait_seconds_total', 'Seconds of flood wait imposed by Telegram'))
+ACTIVE_TASKS = METRICS.register(Gauge(
+    'forwarder_active_tasks', 'Forwarding tasks currently scheduled'))
+SCHEDULER_BACKLOG = METRICS.register(Gauge(
+    'forwarder_scheduler_backlog', 'Due forward batches waiting for a worker'))
+STARTUP_PHASES = METRICS.register(Gauge(
+    'forwarder_startup_phase_seconds', 'Wall time of each startup phase', ('phase',)))
+STORAGE_FLUSH = METRICS.register(Histogram(
+    'forwarder_storage_flush_seconds', 'Storage flush time; prepare runs on the event loop',
+    ('backend', 'phase')))
+HANDLER_LATENCY = METRICS.register(Histogram(
+    'forwarder_handler_latency_seconds', 'Event handler wall time per command', ('handler',)))
+FORWARD_BATCH_LATENCY = METRICS.register(Histogram(
+    'forwarder_forward_batch_seconds', 'Wall time of a scheduled forward batch, rate limiting included'))
+INBOUND_QUEUE_DEPTH = METRICS.register(Gauge(
+    'forwarder_inbound_queue_depth', 'Updates waiting for a handler, per dispatch lane', ('lane',)))
+INBOUND_WAIT = METRICS.register(Histogram(
+    'forwarder_inbound_wait_seconds', 'Time updates spend queued before their handler starts'))
+INBOUND_BACKPRESSURE = METRICS.register(Counter(
+    'forwarder_inbound_backpressure_total', 'Updates that found their dispatch lane full and had to wait'))
+# Only recorded where forwards are sent, i.e. by shard workers in sharded mode
+FORWARDING_METRICS = (FORWARD_LATENCY, FORWARD_RESULTS, FLOOD_WAITS, FLOOD_WAIT_SECONDS,
+                      FORWARD_BATCH_LATENCY)
+
+
+class StartupTimer:
+    """Wall time of consecutive startup phases"""
+    
+    def __init__(self, started: float = IMPORT_STARTED):
+        self.started = started
+        self.phases: List[Tuple[str, float]] = []
+        self._last = started
+    
+    def mark(self, phase: str):
+        """End phase now; it began where the previous phase ended"""
+        now = time.perf_counter()
+        self.record(phase, now - self._last)
+        self._last = now
+    
+    def record(self, phase: str, seconds: float):
+        """Record a phase timed elsewhere, e.g. one running in the background"""
+        self.phases.append((phase, seconds))
+        STARTUP_PHASES.set(seconds, phase)
+    
+    def report(self) -> str:
+        """One-line summary of the phases so far"""
+        phases = ', '.join(f"{phase} {seconds:.3f}s" for phase, seconds in self.phases)
+        return f"{phases} (ready after {self._last - self.started:.3f}s)"
+
+
+class Profiler:
+    """cProfile over the event loop thread for a fixed number of seconds"""
+    
+    def __init__(self, output_dir: str = PROFILE_DIR):
+        self.output_dir = Path(output_dir)
+        self._task: Optional[asyncio.Task] = None
+    
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+    
+    def start(self, seconds: float) -> Optional[asyncio.Task]:
+        """Start profiling; returns the task resolving to the dump path, None if already running"""
+        # cProfile supports only one active profile per thread
+        if self.running:
+            return None
+        self._task = asyncio.create_task(self._run(min(seconds, PROFILE_MAX_SECONDS)))
+        return self._task
+    
+    async def _run(self, seconds: float) -> Path:
+        """Profile every coroutine on the loop for seconds, then dump .prof and .txt files"""
+        profile = cProfile.Profile()
+        logger.info(f"Profiling for {seconds:g}s")
+        profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+        
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        # Shard workers profile too, so keep their dumps apart
+        path = self.output_dir / f"profile-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}.prof"
+        profile.dump_stats(path)
+        # Readable summary next to the raw stats for pstats/snakeviz
+        with open(path.with_suffix('.txt'), 'w', encoding='utf-8') as f:
+            pstats.Stats(profile, stream=f).sort_stats('cumulative').print_stats(50)
+        logger.info(f"Profile written to {path}")
+        return path
+
+# ==================== DATA MANAGEMENT ====================
+class DataManager:
+    """Manages local storage for bot data"""
+    
+    def __init__(self, data_file: str = DATA_FILE, mode: str = STORAGE_MODE,
+                 journal_file: str = JOURNAL_FILE, messages_file: str = MESSAGES_FILE):
+        self.data_file = Path(data_file)
+        self.messages_file = Path(messages_file)
+        self.journal_file = Path(journal_file)
+        self.journal_mode = mode == 'journal'
+        self.journal_entries = 0
+        # Each journal segment starts with a 'segment' record carrying its generation;
+        # a snapshot stores the last generation it folds in as 'journal_generation'
+        self.journal_generation = 0
+        self._journal = None
+        self.data = self._load_data()
+        # (user_id, task_id) -> task dict inside self.data, kept in step by _apply()
+        self._task_index: Dict[Tuple[int, int], dict] = {}
+        self._index_tasks()
+        
+        # Write-behind state: mutations are applied in memory immediately and
+        # written out by flush(), either from run_flusher() or explicitly
+        self.dirty = 0
+        self._pending_records: List[str] = []
+        self._flush_requested = asyncio.Event()
+        self._io_lock = threading.Lock()
+        
+        if self.journal_mode:
+            live_generation = self._replay_journal()
+            self._journal = open(self.journal_file, 'a', encoding='utf-8')
+            if live_generation is None:
+                self._start_segment()
+        self._migrate_legacy_states()
+        
+        # Captured source messages live in MESSAGES_FILE, one JSON line each, and are
+        # read back on a miss; only their offsets are kept in memory
+        self._message_offsets: Dict[Tuple[int, int], int] = {}
+        self._messages = None
+        self._open_messages()
+    
+    def _referenced_messages(self) -> set:
+        """(user_id, message_id) of every source message a task or stored setup uses"""
+        referenced = set()
+        for (user_id, _), task in self._task_index.items():
+            for message_id in task.get('source_msg_ids') or [task.get('source_msg_id')]:
+                referenced.add((user_id, message_id))
+        for user_key, entry in self.data.get('conversations', {}).items():
+            state = entry['state']
+            for message_id in state.get('source_msg_ids') or [state.get('source_msg_id')]:
+                referenced.add((int(user_key), message_id))
+        return referenced
+    
+    def _open_messages(self):
+        """Index MESSAGES_FILE, moving in records that older versions kept in data['messages']
+        and dropping records no task or stored setup uses"""
+        lines = 0
+        if self.messages_file.exists():
+            with open(self.messages_file, 'rb') as f:
+                offset = 0
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self._message_offsets[(entry['user'], entry['id'])] = offset
+                        lines += 1
+                    except (json.JSONDecodeError, KeyError):
+                        logger.warning(f"Skipping corrupt record in {self.messages_file} at byte {offset}")
+                    offset += len(line)
+        
+        legacy = {
+            (int(user_key), int(message_id)): record
+            for user_key, records in self.data.pop('messages', {}).items()
+            for message_id, record in records.items()
+        }
+        if legacy:
+            # The next snapshot leaves them out
+            self.save_data()
+        
+        referenced = self._referenced_messages()
+        keep = {key for key in set(self._message_offsets) | set(legacy) if key in referenced}
+        if legacy or lines > len(keep):
+            self._rewrite_messages(keep, legacy)
+        self._messages = open(self.messages_file, 'a+b')
+        self._messages_prune_at = max(MESSAGES_PRUNE_THRESHOLD, 2 * len(self._message_offsets))
+    
+    def _prune_messages(self):
+        """Drop records of removed tasks and abandoned setups once enough have built up"""
+        if len(self._message_offsets) < self._messages_prune_at:
+            return
+        referenced = self._referenced_messages()
+        keep = {key for key in self._message_offsets if key in referenced}
+        if len(keep) < len(self._message_offsets):
+            with self._io_lock:
+                self._messages.close()
+                try:
+                    self._rewrite_messages(keep, {})
+                except OSError as e:
+                    # The index still matches the old file; try again next time
+                    logger.error(f"Error pruning {self.messages_file}: {e}")
+                finally:
+                    self._messages = open(self.messages_file, 'a+b')
+        self._messages_prune_at = max(MESSAGES_PRUNE_THRESHOLD, 2 * len(self._message_offsets))
+    
+    def _rewrite_messages(self, keep: set, legacy: Dict[Tuple[int, int], dict]):
+        """Replace MESSAGES_FILE with one record per key in keep"""
+        tmp_file = self.messages_file.with_name(self.messages_file.name + '.tmp')
+        offsets = {}
+        with open(tmp_file, 'wb') as dst, open(self.messages_file, 'a+b') as src:
+            for key in keep:
+                if key in self._message_offsets:
+                    src.seek(self._message_offsets[key])
+                    line = src.readline()
+                else:
+                    line = self._message_line(key, legacy[key])
+                offsets[key] = dst.tell()
+                dst.write(line)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_file, self.messages_file)
+        self._message_offsets = offsets
+    
+    @staticmethod
+    def _message_line(key: Tuple[int, int], record: dict) -> bytes:
+        return (json.dumps({'user': key[0], 'id': key[1], 'message': record},
+                           ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+    
+    def _migrate_legacy_states(self):
+        """Move conversation state from top-level user keys into 'conversations'"""
+        expires_at = time.time() + CONVERSATION_TTL
+        for user_key in [key for key in self.data if key.isdigit()]:
+            user_id = int(user_key)
+            self._commit({
+                'op': 'set_conversation', 'user': user_id,
+                'state': self.data[user_key], 'expires_at': expires_at
+            })
+            self._commit({'op': 'clear_state', 'user': user_id})
+    
+    def _load_data(self) -> dict:
+        """Load data from JSON file"""
+        if self.data_file.exists():
+            try:
+                with open(self.data_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (json.JSONDecodeError, IOError) as e:
+                logger.error(f"Error loading data: {e}")
+                return {}
+        return {}
+    
+    def _index_tasks(self):
+        """Index loaded tasks and make sure no task ID can be handed out again"""
+        task_seq = self.data.setdefault('task_seq', {})
+        for user_key, tasks in self.data.get('tasks', {}).items():
+            for task in tasks:
+                self._task_index[(int(user_key), task['id'])] = task
+                task_seq[user_key] = max(task_seq.get(user_key, 0), task['id'])
+    
+    def _replay_journal(self) -> Optional[int]:
+        """Apply journal records the snapshot doesn't cover; returns the live segment's generation"""
+        covered = self.data.get('journal_generation', 0)
+        self.journal_generation = covered
+        live_generation = None
+        # A rotated segment exists only if compaction failed or the process died
+        # mid-compaction; in the latter case the snapshot may already cover it
+        for journal_file in (self._rotated_journal_file(), self.journal_file):
+            if not journal_file.exists():
+                continue
+            # Journals written before generations have no segment record and always replay
+            generation = None
+            try:
+                with open(journal_file, 'r', encoding='utf-8') as f:
+                    for line_no, line in enumerate(f, 1):
+                        if not line.strip():
+                            continue
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            # A torn tail from a crash mid-append; everything before it is intact
+                            logger.warning(f"Skipping corrupt record at {journal_file}:{line_no}")
+                            continue
+                        if record['op'] == 'segment':
+                            # A failed compaction appends segments to each other
+                            generation = record['generation']
+                            self.journal_generation = max(self.journal_generation, generation)
+                            continue
+                        if generation is not None and generation <= covered:
+                            continue
+                        self._apply(record)
+                        self.journal_entries += 1
+            except IOError as e:
+                logger.error(f"Error replaying journal: {e}")
+            if journal_file == self.journal_file and generation is not None and generation > covered:
+                live_generation = generation
+        
+        if self.journal_entries:
+            logger.info(f"Replayed {self.journal_entries} journal records")
+        return live_generation
+    
+    def _start_segment(self):
+        """Begin a new journal generation in the live journal"""
+        self.journal_generation += 1
+        self._journal.write(json.dumps({'op': 'segment', 'generation': self.journal_generation}) + '\n')
+        self._journal.flush()
+    
+    def _rotated_journal_file(self) -> Path:
+        """Journal segment being folded into the snapshot"""
+        return self.journal_file.with_name(self.journal_file.name + '.1')
+    
+    def _apply(self, record: dict):
+        """Apply a single mutation record to the in-memory data"""
+        op = record['op']
+        user_key = str(record['user'])
+        
+        if op == 'set_conversation':
+            self.data.setdefault('conversations', {})[user_key] = {
+                'state': record['state'],
+                'expires_at': record['expires_at']
+            }
+        
+        elif op == 'clear_conversation':
+            self.data.get('conversations', {}).pop(user_key, None)
+        
+        # Conversation state used to live under top-level user keys
+        elif op == 'set_state':
+            self.data[user_key] = record['state']
+        
+        elif op == 'clear_state':
+            self.data.pop(user_key, None)
+        
+        elif op == 'add_task':
+            user_tasks = self.data.setdefault('tasks', {}).setdefault(user_key, [])
+            task = record['task']
+            key = (int(user_key), task['id'])
+            # Journals from before segment generations can repeat a task the snapshot has
+            existing = self._task_index.get(key)
+            if existing is not None:
+                user_tasks[user_tasks.index(existing)] = task
+            else:
+                user_tasks.append(task)
+            self._task_index[key] = task
+            task_seq = self.data.setdefault('task_seq', {})
+            task_seq[user_key] = max(task_seq.get(user_key, 0), task['id'])
+        
+        elif op == 'remove_task':
+            task = self._task_index.pop((int(user_key), record['task_id']), None)
+            if task is not None:
+                self.data['tasks'][user_key].remove(task)
+        
+        elif op == 'update_task':
+            task = self._task_index.get((int(user_key), record['task_id']))
+            if task is not None:
+                task.update(record['fields'])
+        
+        # Message records from before MESSAGES_FILE; _open_messages() moves them there
+        elif op == 'set_message':
+            messages = self.data.setdefault('messages', {}).setdefault(user_key, {})
+            messages[str(record['message_id'])] = record['message']
+    
+    def _commit(self, record: dict):
+        """Apply a mutation and queue it for the next flush"""
+        self._apply(record)
+        
+        if self.journal_mode:
+            self._pending_records.append(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self.save_data()
+    
+    def save_data(self):
+        """Mark data dirty; it is written on the next flush"""
+        self.dirty += 1
+        if self.dirty >= SAVE_BATCH_SIZE:
+            self._flush_requested.set()
+    
+    def _serialize_snapshot(self) -> str:
+        """Serialize the current data for a snapshot write"""
+        return json.dumps(self.data, ensure_ascii=False, separators=(',', ':'))
+    
+    def _atomic_write(self, payload: str):
+        """Write the snapshot via temp file + fsync + rename so a crash never truncates it"""
+        tmp_file = self.data_file.with_name(self.data_file.name + '.tmp')
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.data_file)
+    
+    def _rotate_journal(self) -> Path:
+        """Move the live journal aside so new appends go to a fresh segment"""
+        rotated = self._rotated_journal_file()
+        self._journal.close()
+        if rotated.exists():
+            # A previous compaction failed; keep its records ahead of ours
+            with open(rotated, 'a', encoding='utf-8') as dst, \
+                    open(self.journal_file, 'r', encoding='utf-8') as src:
+                dst.write(src.read())
+            os.remove(self.journal_file)
+        else:
+            os.replace(self.journal_file, rotated)
+        self._journal = open(self.journal_file, 'a', encoding='utf-8')
+        self._start_segment()
+        self.journal_entries = 0
+        return rotated
+    
+    def _write_snapshot(self, payload: str, rotated: Optional[Path] = None):
+        """Write a snapshot and drop the journal segment it folds in"""
+        with self._io_lock:
+            self._atomic_write(payload)
+            if rotated is not None:
+                rotated.unlink()
+    
+    def _compact(self, payload: str, rotated: Path, lines: str):
+        """Fold the rotated journal segment and the records queued with it into a snapshot"""
+        with self._io_lock:
+            # Once the queued records are in the segment, a failed snapshot loses nothing
+            with open(rotated, 'a', encoding='utf-8') as f:
+                f.write(lines)
+                f.flush()
+        try:
+            self._write_snapshot(payload, rotated)
+        except OSError as e:
+            # The segment stays on disk and is folded in by the next compaction
+            logger.error(f"Error writing snapshot: {e}")
+    
+    def _append_journal(self, lines: str):
+        """Append queued journal records"""
+        with self._io_lock:
+            self._journal.write(lines)
+            self._journal.flush()
+    
+    def _prepare_flush(self) -> Optional[tuple]:
+        """Capture pending changes on the loop thread; returns (writer, *args) or None"""
+        if not self.dirty:
+            return None
+        self.dirty = 0
+        self._flush_requested.clear()
+        
+        if not self.journal_mode:
+            return self._write_snapshot, self._serialize_snapshot()
+        
+        if self.journal_entries + len(self._pending_records) >= JOURNAL_COMPACT_THRESHOLD:
+            # The snapshot contains the pending records too, but they are only dropped
+            # once they are on disk with the segment it folds in (see _compact)
+            lines = ''.join(self._pending_records)
+            self._pending_records = []
+            with self._io_lock:
+                rotated = self._rotate_journal()
+            # Replay skips the rotated segment once this snapshot is on disk
+            self.data['journal_generation'] = self.journal_generation - 1
+            return self._compact, self._serialize_snapshot(), rotated, lines
+        
+        lines = ''.join(self._pending_records)
+        self.journal_entries += len(self._pending_records)
+        self._pending_records = []
+        return self._append_journal, lines
+    
+    def _flush_failed(self, job: tuple, error: Exception):
+        """Keep data dirty after a failed write so the next flush retries it"""
+        logger.error(f"Error saving data: {error}")
+        if job[0] == self._append_journal:
+            self._pending_records.insert(0, job[1])
+            self.journal_entries -= job[1].count('\n')
+        elif job[0] == self._compact:
+            # They never reached the old segment; they go to the new one, which
+            # replays after it, so the order of records is kept
+            self._pending_records.insert(0, job[3])
+        self.dirty += 1
+    
+    def flush(self):
+        """Write all pending changes now"""
+        started = time.perf_counter()
+        job = self._prepare_flush()
+        if job is None:
+            return
+        prepared = time.perf_counter()
+        STORAGE_FLUSH.observe(prepared - started, 'json', 'prepare')
+        try:
+            job[0](*job[1:])
+        except OSError as e:
+            self._flush_failed(job, e)
+        STORAGE_FLUSH.observe(time.perf_counter() - prepared, 'json', 'write')
+    
+    async def run_flusher(self):
+        """Flush pending changes off the event loop on an interval or batch threshold"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=SAVE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            
+            # On the loop, so setups can't reference a record while it is dropped
+            self._prune_messages()
+            
+            started = time.perf_counter()
+            job = self._prepare_flush()
+            if job is None:
+                continue
+            prepared = time.perf_counter()
+            STORAGE_FLUSH.observe(prepared - started, 'json', 'prepare')
+            try:
+                await loop.run_in_executor(None, *job)
+            except OSError as e:
+                self._flush_failed(job, e)
+            STORAGE_FLUSH.observe(time.perf_counter() - prepared, 'json', 'write')
+    
+    def close(self):
+        """Release the journal and message files; call flush() first"""
+        with self._io_lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            if self._messages is not None:
+                self._messages.close()
+                self._messages = None
+    
+    def load_conversations(self) -> Iterator[Tuple[int, dict, float]]:
+        """Yield (user_id, state, expires_at) for every stored conversation"""
+        for user_key, entry in list(self.data.get('conversations', {}).items()):
+            yield int(user_key), entry['state'], entry['expires_at']
+    
+    def save_conversation(self, user_id: int, state: dict, expires_at: float):
+        """Store a user's setup conversation"""
+        self._commit({'op': 'set_conversation', 'user': user_id, 'state': state, 'expires_at': expires_at})
+    
+    def delete_conversation(self, user_id: int):
+        """Remove a user's stored setup conversation"""
+        if str(user_id) in self.data.get('conversations', {}):
+            self._commit({'op': 'clear_conversation', 'user': user_id})
+    
+    def add_forwarding_task(self, user_id: int, task_data: dict):
+        """Add a forwarding task for user"""
+        # IDs are never reused, even after remove_task
+        task_data['id'] = self.data.get('task_seq', {}).get(str(user_id), 0) + 1
+        task_data['created_at'] = datetime.now().isoformat()
+        task_data['last_forward'] = datetime.now().isoformat()
+        task_data['forward_count'] = 0
+        self._commit({'op': 'add_task', 'user': user_id, 'task': task_data})
+        return task_data['id']
+    
+    def get_user_tasks(self, user_id: int) -> List[dict]:
+        """Get all tasks for a user"""
+        return self.data.get('tasks', {}).get(str(user_id), [])
+    
+    def remove_task(self, user_id: int, task_id: int):
+        """Remove a specific task"""
+        if (user_id, task_id) in self._task_index:
+            self._commit({'op': 'remove_task', 'user': user_id, 'task_id': task_id})
+    
+    def update_task(self, user_id: int, task_id: int, fields: dict):
+        """Update fields of a specific task"""
+        if (user_id, task_id) in self._task_index:
+            self._commit({'op': 'update_task', 'user': user_id, 'task_id': task_id, 'fields': fields})
+    
+    def update_task_last_forward(self, user_id: int, task_id: int):
+        """Update last forward time and count for task"""
+        task = self._task_index.get((user_id, task_id))
+        if task is not None:
+            self.update_task(user_id, task_id, {
+                'last_forward': datetime.now().isoformat(),
+                'forward_count': task.get('forward_count', 0) + 1
+            })
+    
+    def get_task(self, user_id: int, task_id: int) -> Optional[dict]:
+        """Get a specific task"""
+        return self._task_index.get((user_id, task_id))
+    
+    def get_active_tasks(self) -> Iterator[Tuple[int, dict]]:
+        """Yield (user_id, task) for every active task"""
+        for user_id_str, tasks in self.data.get('tasks', {}).items():
+            for task in tasks:
+                if task.get('status') == 'active':
+                    yield int(user_id_str), task
+    
+    def save_message_record(self, user_id: int, message_id: int, record: dict):
+        """Persist a captured source message record"""
+        # Written straight away: records come once per setup, not per forward
+        key = (user_id, message_id)
+        with self._io_lock:
+            offset = self._messages.seek(0, os.SEEK_END)
+            self._messages.write(self._message_line(key, record))
+            self._messages.flush()
+        self._message_offsets[key] = offset
+    
+    def get_message_record(self, user_id: int, message_id: int) -> Optional[dict]:
+        """Get a captured source message record"""
+        offset = self._message_offsets.get((user_id, message_id))
+        if offset is None:
+            return None
+        with self._io_lock:
+            self._messages.seek(offset)
+            line = self._messages.readline()
+        return json.loads(line)['message']
+
+
+class SQLiteDataManager:
+    """Stores bot data in SQLite with indexed, single-row task updates"""
+    
+    # Task fields kept in their own columns; everything else lives in the JSON blob
+    TASK_COLUMNS = ('status', 'forward_count', 'last_forward', 'stopped_at')
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS user_states (
+            user_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS tasks (
+            user_id INTEGER NOT NULL,
+            task_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'active',
+            forward_count INTEGER NOT NULL DEFAULT 0,
+            last_forward TEXT,
+            stopped_at TEXT,
+            data TEXT NOT NULL,
+            PRIMARY KEY (user_id, task_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status);
+        CREATE TABLE IF NOT EXISTS task_seq (
+            user_id INTEGER PRIMARY KEY,
+            last_id INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            user_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            record TEXT NOT NULL,
+            PRIMARY KEY (user_id, message_id)
+        );
+        CREATE TABLE IF NOT EXISTS shard_workers (
+            worker_id TEXT PRIMARY KEY,
+            heartbeat REAL NOT NULL
+        );
+    """
+    
+    SQL_LOAD_CONVERSATIONS = "SELECT user_id, state, expires_at FROM conversations"
+    SQL_SAVE_CONVERSATION = "INSERT OR REPLACE INTO conversations (user_id, state, expires_at) VALUES (?, ?, ?)"
+    SQL_DELETE_CONVERSATION = "DELETE FROM conversations WHERE user_id = ?"
+    # user_states held conversation state before the conversations table
+    SQL_MIGRATE_STATES = """
+        INSERT OR IGNORE INTO conversations (user_id, state, expires_at)
+        SELECT user_id, state, ? FROM user_states
+    """
+    # task_seq starts from the highest existing ID so databases from before it keep counting
+    SQL_SEED_TASK_SEQ = """
+        INSERT OR IGNORE INTO task_seq (user_id, last_id)
+        SELECT ?, COALESCE(MAX(task_id), 0) FROM tasks WHERE user_id = ?
+    """
+    SQL_BUMP_TASK_SEQ = "UPDATE task_seq SET last_id = last_id + 1 WHERE user_id = ?"
+    SQL_GET_TASK_SEQ = "SELECT last_id FROM task_seq WHERE user_id = ?"
+    SQL_INSERT_TASK = """
+        INSERT OR REPLACE INTO tasks
+            (user_id, task_id, status, forward_count, last_forward, stopped_at, data)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """
+    SQL_TASK_SELECT = """
+        SELECT user_id, task_id, status, forward_count, last_forward, stopped_at, data
+        FROM tasks
+    """
+    SQL_USER_TASKS = SQL_TASK_SELECT + " WHERE user_id = ? ORDER BY task_id"
+    SQL_ACTIVE_TASKS = SQL_TASK_SELECT + " WHERE status = 'active'"
+    SQL_GET_TASK = SQL_TASK_SELECT + " WHERE user_id = ? AND task_id = ?"
+    # Hash partition of (user_id, task_id) over count live workers
+    SQL_SHARD_TASKS = SQL_ACTIVE_TASKS + " AND (user_id * 1000003 + task_id) % ? = ?"
+    SQL_REMOVE_TASK = "DELETE FROM tasks WHERE user_id = ? AND task_id = ?"
+    SQL_TOUCH_TASK = """
+        UPDATE tasks SET last_forward = ?, forward_count = forward_count + 1
+        WHERE user_id = ? AND task_id = ?
+    """
+    SQL_SET_MESSAGE = "INSERT OR REPLACE INTO messages (user_id, message_id, record) VALUES (?, ?, ?)"
+    SQL_GET_MESSAGE = "SELECT record FROM messages WHERE user_id = ? AND message_id = ?"
+    SQL_PATCH_TASK_DATA = "UPDATE tasks SET data = json_patch(data, ?) WHERE user_id = ? AND task_id = ?"
+    SQL_HEARTBEAT = "INSERT OR REPLACE INTO shard_workers (worker_id, heartbeat) VALUES (?, ?)"
+    SQL_REMOVE_WORKER = "DELETE FROM shard_workers WHERE worker_id = ?"
+    SQL_LIVE_WORKERS = "SELECT worker_id FROM shard_workers WHERE heartbeat >= ? ORDER BY worker_id"
+    
+    def __init__(self, db_file: str = SQLITE_FILE, legacy_data_file: str = DATA_FILE,
+                 write_behind: bool = True):
+        self.db_file = Path(db_file)
+        self.conn = sqlite3.connect(self.db_file, cached_statements=256)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # Other processes may hold the write lock briefly in sharded mode
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.executescript(self.SCHEMA)
+        with self.conn:
+            self.conn.execute(self.SQL_MIGRATE_STATES, (time.time() + CONVERSATION_TTL,))
+            self.conn.execute("DELETE FROM user_states")
+        # An open write-behind transaction holds the database write lock, so
+        # processes sharing the database commit every write instead
+        self.write_behind = write_behind
+        self.dirty = 0
+        self._flush_requested = asyncio.Event()
+        self._import_json(Path(legacy_data_file))
+    
+    def _import_json(self, data_file: Path):
+        """One-time import of an existing JSON data file into an empty database"""
+        if not data_file.exists():
+            return
+        if self.conn.execute("SELECT 1 FROM tasks LIMIT 1").fetchone():
+            return
+        
+        try:
+            with open(data_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            logger.error(f"Error importing {data_file}: {e}")
+            return
+        
+        imported = 0
+        with self.conn:
+            for user_id_str, tasks in data.get('tasks', {}).items():
+                for task in tasks:
+                    self._insert_task(int(user_id_str), task)
+                    imported += 1
+        logger.info(f"Imported {imported} tasks from {data_file}")
+    
+    def _row_to_task(self, row: tuple) -> dict:
+        """Rebuild a task dict from a tasks row"""
+        user_id, task_id, status, forward_count, last_forward, stopped_at, data = row
+        task = json.loads(data)
+        task.update({
+            'id': task_id,
+            'status': status,
+            'forward_count': forward_count,
+            'last_forward': last_forward
+        })
+        if stopped_at:
+            task['stopped_at'] = stopped_at
+        return task
+    
+    def _insert_task(self, user_id: int, task: dict):
+        """Insert or replace a task row"""
+        blob = {k: v for k, v in task.items() if k != 'id' and k not in self.TASK_COLUMNS}
+        self.conn.execute(self.SQL_INSERT_TASK, (
+            user_id,
+            task['id'],
+            task.get('status', 'active'),
+            task.get('forward_count', 0),
+            task.get('last_forward'),
+            task.get('stopped_at'),
+            json.dumps(blob, ensure_ascii=False, separators=(',', ':'))
+        ))
+    
+    def _write(self, sql: str, params: tuple):
+        """Run a single write statement inside the open write-behind transaction"""
+        try:
+            self.conn.execute(sql, params)
+        except sqlite3.Error as e:
+            logger.error(f"Error saving data: {e}")
+            return
+        self.save_data()
+    
+    def save_data(self):
+        """Mark data dirty; the open transaction is committed on the next flush"""
+        self.dirty += 1
+        if not self.write_behind:
+            self.flush()
+        elif self.dirty >= SAVE_BATCH_SIZE:
+            self._flush_requested.set()
+    
+    def flush(self):
+        """Commit pending writes now"""
+        if not self.dirty:
+            return
+        self.dirty = 0
+        self._flush_requested.clear()
+        started = time.perf_counter()
+        try:
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error saving data: {e}")
+        STORAGE_FLUSH.observe(time.perf_counter() - started, 'sqlite', 'write')
+    
+    async def run_flusher(self):
+        """Commit pending writes on an interval or batch threshold"""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=SAVE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            # In WAL mode with synchronous=NORMAL a commit does not fsync, so it stays on the loop
+            self.flush()
+    
+    def close(self):
+        """Close the database; call flush() first"""
+        self.conn.close()
+    
+    def load_conversations(self) -> Iterator[Tuple[int, dict, float]]:
+        """Yield (user_id, state, expires_at) for every stored conversation"""
+        for user_id, state, expires_at in self.conn.execute(self.SQL_LOAD_CONVERSATIONS).fetchall():
+            yield user_id, json.loads(state), expires_at
+    
+    def save_conversation(self, user_id: int, state: dict, expires_at: float):
+        """Store a user's setup conversation"""
+        self._write(self.SQL_SAVE_CONVERSATION, (user_id, json.dumps(state, ensure_ascii=False), expires_at))
+    
+    def delete_conversation(self, user_id: int):
+        """Remove a user's stored setup conversation"""
+        self._write(self.SQL_DELETE_CONVERSATION, (user_id,))
+    
+    def _next_task_id(self, user_id: int) -> int:
+        """Allocate the user's next task ID; IDs are never reused, even after remove_task"""
+        self.conn.execute(self.SQL_SEED_TASK_SEQ, (user_id, user_id))
+        self.conn.execute(self.SQL_BUMP_TASK_SEQ, (user_id,))
+        return self.conn.execute(self.SQL_GET_TASK_SEQ, (user_id,)).fetchone()[0]
+    
+    def add_forwarding_task(self, user_id: int, task_data: dict):
+        """Add a forwarding task for user"""
+        task_data['id'] = self._next_task_id(user_id)
+        task_data['created_at'] = datetime.now().isoformat()
+        task_data['last_forward'] = datetime.now().isoformat()
+        task_data['forward_count'] = 0
+        try:
+            self._insert_task(user_id, task_data)
+        except sqlite3.Error as e:
+            logger.error(f"Error saving data: {e}")
+        else:
+            self.save_data()
+        return task_data['id']
+    
+    def get_user_tasks(self, user_id: int) -> List[dict]:
+        """Get all tasks for a user"""
+        return [self._row_to_task(row) for row in self.conn.execute(self.SQL_USER_TASKS, (user_id,))]
+    
+    def remove_task(self, user_id: int, task_id: int):
+        """Remove a specific task"""
+        self._write(self.SQL_REMOVE_TASK, (user_id, task_id))
+    
+    def update_task(self, user_id: int, task_id: int, fields: dict):
+        """Update fields of a specific task"""
+        columns = {k: v for k, v in fields.items() if k in self.TASK_COLUMNS}
+        blob = {k: v for k, v in fields.items() if k not in self.TASK_COLUMNS}
+        if columns:
+            # Column names come from TASK_COLUMNS, never from caller input
+            assignments = ', '.join(f"{k} = ?" for k in columns)
+            self._write(
+                f"UPDATE tasks SET {assignments} WHERE user_id = ? AND task_id = ?",
+                (*columns.values(), user_id, task_id)
+            )
+        if blob:
+            self._write(self.SQL_PATCH_TASK_DATA, (
+                json.dumps(blob, ensure_ascii=False), user_id, task_id
+            ))
+    
+    def update_task_last_forward(self, user_id: int, task_id: int):
+        """Update last forward time and count for task"""
+        self._write(self.SQL_TOUCH_TASK, (datetime.now().isoformat(), user_id, task_id))
+    
+    def get_task(self, user_id: int, task_id: int) -> Optional[dict]:
+        """Get a specific task"""
+        row = self.conn.execute(self.SQL_GET_TASK, (user_id, task_id)).fetchone()
+        return self._row_to_task(row) if row else None
+    
+    def get_active_tasks(self) -> Iterator[Tuple[int, dict]]:
+        """Yield (user_id, task) for every active task"""
+        for row in self.conn.execute(self.SQL_ACTIVE_TASKS).fetchall():
+            yield row[0], self._row_to_task(row)
+    
+    def get_shard_tasks(self, index: int, count: int) -> Iterator[Tuple[int, dict]]:
+        """Yield (user_id, task) for every active task in shard index of count"""
+        for row in self.conn.execute(self.SQL_SHARD_TASKS, (count, index)).fetchall():
+            yield row[0], self._row_to_task(row)
+    
+    def heartbeat_worker(self, worker_id: str):
+        """Record that a shard worker is alive"""
+        with self.conn:
+            self.conn.execute(self.SQL_HEARTBEAT, (worker_id, time.time()))
+    
+    def remove_worker(self, worker_id: str):
+        """Drop a shard worker from membership"""
+        with self.conn:
+            self.conn.execute(self.SQL_REMOVE_WORKER, (worker_id,))
+    
+    def get_live_workers(self, timeout: float = SHARD_HEARTBEAT_TIMEOUT) -> List[str]:
+        """IDs of shard workers that sent a heartbeat within timeout seconds, sorted"""
+        rows = self.conn.execute(self.SQL_LIVE_WORKERS, (time.time() - timeout,))
+        return [row[0] for row in rows]
+    
+    def save_message_record(self, user_id: int, message_id: int, record: dict):
+        """Persist a captured source message record"""
+        self._write(self.SQL_SET_MESSAGE, (user_id, message_id, json.dumps(record, ensure_ascii=False)))
+    
+    def get_message_record(self, user_id: int, message_id: int) -> Optional[dict]:
+        """Get a captured source message record"""
+        row = self.conn.execute(self.SQL_GET_MESSAGE, (user_id, message_id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+STORAGE_BACKENDS = {
+    'json': DataManager,
+    'sqlite': SQLiteDataManager,
+}
+
+
+def create_data_manager(backend: str = STORAGE_BACKEND, **options):
+    """Create the configured storage backend"""
+    try:
+        manager_class = STORAGE_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown storage backend: {backend}")
+    return manager_class(**options)
+
+# ==================== TASKS ====================
+class TaskRegistry:
+    """Tasks keyed by (user_id, task_id), indexed by target chat and status; writes go through to storage"""
+    
+    # Allowed status changes; stopped is final
+    TRANSITIONS = {
+        'active': {'stopped'},
+        'stopped': set(),
+    }
+    
+    # Upper bounds in seconds of the delivery latency buckets kept per task
+    LATENCY_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 30)
+    
+    def __init__(self, data_manager):
+        self.data_manager = data_manager
+        self._tasks: Dict[Tuple[int, int], dict] = {}
+        self._by_user: Dict[int, Dict[int, dict]] = defaultdict(dict)
+        self._by_chat: Dict[int, set] = defaultdict(set)
+        self._by_status: Dict[str, set] = defaultdict(set)
+        # Users whose stopped tasks have been read too; load() only reads active ones
+        self._complete_users: set = set()
+    
+    def __len__(self):
+        return len(self._tasks)
+    
+    def __contains__(self, key: Tuple[int, int]):
+        return key in self._tasks
+    
+    def load(self):
+        """Index every active task; stopped ones are read per user by user_tasks()"""
+        for user_id, task in self.data_manager.get_active_tasks():
+            self.track(user_id, task)
+    
+    def track(self, user_id: int, task: dict):
+        """Index a task that already exists in storage"""
+        key = (user_id, task['id'])
+        self.untrack(*key)
+        self._tasks[key] = task
+        self._by_user[user_id][task['id']] = task
+        self._by_chat[task.get('target_chat_id')].add(key)
+        self._by_status[task.get('status', 'active')].add(key)
+    
+    def untrack(self, user_id: int, task_id: int) -> Optional[dict]:
+        """Drop a task from the indexes, leaving storage alone"""
+        key = (user_id, task_id)
+        task = self._tasks.pop(key, None)
+        if task is None:
+            return None
+        user_tasks = self._by_user[user_id]
+        del user_tasks[task_id]
+        if not user_tasks:
+            del self._by_user[user_id]
+        self._discard(self._by_chat, task.get('target_chat_id'), key)
+        self._discard(self._by_status, task.get('status', 'active'), key)
+        return task
+    
+    @staticmethod
+    def _discard(index: dict, value, key: Tuple[int, int]):
+        keys = index.get(value)
+        if keys:
+            keys.discard(key)
+            if not keys:
+                del index[value]
+    
+    def create(self, user_id: int, task_data: dict) -> int:
+        """Store and index a new task, returning its ID"""
+        task_id = self.data_manager.add_forwarding_task(user_id, task_data)
+        self.track(user_id, task_data)
+        return task_id
+    
+    def get(self, user_id: int, task_id: int) -> Optional[dict]:
+        """Get a specific task"""
+        return self._tasks.get((user_id, task_id))
+    
+    @staticmethod
+    def input_peer(task: dict):
+        """Peer to forward a task to; built from the stored peer ID and access hash,
+        so processes that never resolved the target (shard workers) can reach it"""
+        if task.get('target_peer') is None:
+            # Tasks set up before peers were stored resolve through the session
+            return task['target_chat_id']
+        peer_id, kind = utils.resolve_id(task['target_peer'])
+        if kind is types.PeerChannel:
+            return types.InputPeerChannel(peer_id, task.get('target_access_hash') or 0)
+        if kind is types.PeerChat:
+            return types.InputPeerChat(peer_id)
+        return types.InputPeerUser(peer_id, task.get('target_access_hash') or 0)
+    
+    @staticmethod
+    def message_ids(task: dict) -> List[int]:
+        """Source message IDs a task forwards; several for an album"""
+        return task.get('source_msg_ids') or [task['source_msg_id']]
+    
+    def user_tasks(self, user_id: int, refresh: bool = False) -> List[dict]:
+        """A user's tasks ordered by ID; stopped ones are read from storage on first
+        use, and refresh re-reads all of them"""
+        if refresh:
+            for task_id in list(self._by_user.get(user_id, ())):
+                self.untrack(user_id, task_id)
+        if refresh or user_id not in self._complete_users:
+            for task in self.data_manager.get_user_tasks(user_id):
+                # Tracked tasks may be scheduled; their dicts must stay the same objects
+                if (user_id, task['id']) not in self._tasks:
+                    self.track(user_id, task)
+            self._complete_users.add(user_id)
+        tasks = self._by_user.get(user_id, {})
+        return [tasks[task_id] for task_id in sorted(tasks)]
+    
+    def chat_tasks(self, chat_id: int) -> List[Tuple[int, dict]]:
+        """(user_id, task) for every task forwarding to chat_id"""
+        return [(key[0], self._tasks[key]) for key in self._by_chat.get(chat_id, ())]
+    
+    def with_status(self, status: str) -> List[Tuple[int, dict]]:
+        """(user_id, task) for every task in status"""
+        return [(key[0], self._tasks[key]) for key in self._by_status.get(status, ())]
+    
+    def count(self, status: str) -> int:
+        """Number of tasks in status"""
+        return len(self._by_status.get(status, ()))
+    
+    def set_status(self, user_id: int, task_id: int, status: str, **fields) -> bool:
+        """Move a task to status, storing fields alongside; False if missing or not allowed"""
+        key = (user_id, task_id)
+        task = self._tasks.get(key)
+        if task is None:
+            return False
+        previous = task.get('status', 'active')
+        if status not in self.TRANSITIONS.get(previous, ()):
+            return False
+        fields['status'] = status
+        self.data_manager.update_task(user_id, task_id, fields)
+        self._discard(self._by_status, previous, key)
+        task.update(fields)
+        self._by_status[status].add(key)
+        return True
+    
+    def record_attempt(self, user_id: int, task_id: int, outcome: str, latency: float):
+        """Fold a forward attempt into the task's delivery stats; a success also counts as a forward"""
+        task = self._tasks.get((user_id, task_id))
+        success = outcome == 'success'
+        if task is None:
+            if success:
+                self.data_manager.update_task_last_forward(user_id, task_id)
+            return
+        
+        delivery = task.get('delivery') or {}
+        delivery = {
+            'attempts': delivery.get('attempts', 0) + 1,
+            'failures': delivery.get('failures', 0) + (not success),
+            # Successful deliveries only; failures are counted above
+            'latency': list(delivery.get('latency') or [0] * (len(self.LATENCY_BUCKETS) + 1)),
+            'last_error': outcome if not success else delivery.get('last_error'),
+        }
+        fields = {'delivery': delivery}
+        if success:
+            delivery['latency'][bisect.bisect_left(self.LATENCY_BUCKETS, latency)] += 1
+            fields['last_forward'] = datetime.now().isoformat()
+            fields['forward_count'] = task.get('forward_count', 0) + 1
+        self.data_manager.update_task(user_id, task_id, fields)
+        task.update(fields)
+    
+    @classmethod
+    def delivery_summary(cls, tasks: List[dict]) -> Optional[str]:
+        """p50/p95 latency and failure rate over the tasks' delivery stats; None before any attempt"""
+        attempts = failures = 0
+        counts = [0] * (len(cls.LATENCY_BUCKETS) + 1)
+        for task in tasks:
+            delivery = task.get('delivery')
+            if not delivery:
+                continue
+            attempts += delivery['attempts']
+            failures += delivery['failures']
+            counts = [total + count for total, count in zip(counts, delivery['latency'])]
+        if not attempts:
+            return None
+        summary = f"{failures / attempts:.1%} of {attempts} failed"
+        if sum(counts):
+            summary = f"p50 {cls._percentile(counts, 0.5)} · p95 {cls._percentile(counts, 0.95)} · " + summary
+        return summary
+    
+    @classmethod
+    def _percentile(cls, counts: List[int], q: float) -> str:
+        """Upper bound of the bucket holding the q-quantile latency"""
+        rank = q * sum(counts)
+        cumulative = 0
+        for bound, count in zip(cls.LATENCY_BUCKETS, counts):
+            cumulative += count
+            if cumulative >= rank:
+                return f"≤{bound:g}s"
+        return f">{cls.LATENCY_BUCKETS[-1]:g}s"
+
+# ==================== FORWARD LEDGER ====================
+class ForwardLedger:
+    """Append-only JSON-lines history of forward attempts, written in batches off the event loop"""
+    
+    def __init__(self, path: str = LEDGER_FILE, max_bytes: int = LEDGER_MAX_BYTES, backups: int = LEDGER_BACKUPS):
+        # Rotation comes from the logging handler; each batch is written as one record
+        self._handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups,
+                                            encoding='utf-8', delay=True)
+        self._handler.setFormatter(logging.Formatter('%(message)s'))
+        self._pending: List[str] = []
+    
+    def record(self, user_id: int, task_id: int, chat_id: int, outcome: str, latency: Optional[float] = None):
+        """Queue one attempt; outcome is 'success', an error class or 'deferred'"""
+        self._pending.append(json.dumps({
+            'ts': round(time.time(), 3),
+            'user_id': user_id,
+            'task_id': task_id,
+            'chat_id': chat_id,
+            'outcome': outcome,
+            'latency': round(latency, 4) if latency is not None else None,
+        }, separators=(',', ':')))
+    
+    def _write(self, lines: List[str]):
+        self._handler.handle(logging.makeLogRecord({'msg': '\n'.join(lines)}))
+    
+    def flush(self):
+        """Write queued attempts now"""
+        if self._pending:
+            lines, self._pending = self._pending, []
+            self._write(lines)
+    
+    async def run_flusher(self):
+        """Write queued attempts every LEDGER_FLUSH_INTERVAL seconds"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(LEDGER_FLUSH_INTERVAL)
+            if self._pending:
+                lines, self._pending = self._pending, []
+                await loop.run_in_executor(None, self._write, lines)
+    
+    def close(self):
+        """Write what is queued and close the file"""
+        self.flush()
+        self._handler.close()
+
+# ==================== CACHES ====================
+class LRUCache:
+    """Bounded mapping that evicts the least recently used entry"""
+    
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data: OrderedDict = OrderedDict()
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def __contains__(self, key) -> bool:
+        return key in self._data
+    
+    def get(self, key, default=None):
+        """Return a cached value and mark it most recently used"""
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+    
+    def put(self, key, value):
+        """Cache a value, evicting the oldest entry when full"""
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+    
+    def invalidate(self, key):
+        """Drop a cached value if present"""
+        self._data.pop(key, None)
+
+class AsyncTTLCache:
+    """TTL cache for coroutine results that coalesces concurrent lookups of a key"""
+    
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self._values = LRUCache(max_size)
+        self._inflight: Dict[object, asyncio.Future] = {}
+    
+    def put(self, key, value, ttl: Optional[float] = None):
+        """Cache a value for ttl seconds"""
+        self._values.put(key, (time.monotonic() + (ttl or self.ttl), value))
+    
+    def invalidate(self, key):
+        """Forget a cached value"""
+        self._values.invalidate(key)
+    
+    async def get(self, key, fetch, ttl: Optional[float] = None):
+        """Return the cached value for key, or await fetch() once for all concurrent callers"""
+        cached = self._values.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        
+        future = self._inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            # Failures are shared with waiters but never cached
+            future.set_exception(e)
+            future.exception()
+            raise
+        else:
+            self.put(key, value, ttl)
+            future.set_result(value)
+            return value
+        finally:
+            del self._inflight[key]
+
+class MessageStore:
+    """Bounded LRU of compact source message records, backed by persistent storage"""
+    
+    def __init__(self, data_manager, max_size: int = MESSAGE_STORE_SIZE):
+        self.data_manager = data_manager
+        self._records = LRUCache(max_size)
+    
+    def __len__(self) -> int:
+        return len(self._records)
+    
+    def put(self, user_id: int, message_id: int, record: dict):
+        """Cache a record and write it through to storage"""
+        self._records.put((user_id, message_id), record)
+        self.data_manager.save_message_record(user_id, message_id, record)
+    
+    def get(self, user_id: int, message_id: int) -> Optional[dict]:
+        """Read a record from memory, falling back to storage"""
+        record = self._records.get((user_id, message_id))
+        if record is None:
+            record = self.data_manager.get_message_record(user_id, message_id)
+            if record is not None:
+                self._records.put((user_id, message_id), record)
+        return record
+
+# ==================== CONVERSATIONS ====================
+class ConversationManager:
+    """Per-user setup state kept in memory, expiring after a TTL per step"""
+    
+    def __init__(self, data_manager, persist: bool = CONVERSATION_PERSIST,
+                 step_ttls: Dict[str, float] = CONVERSATION_STEP_TTLS):
+        # data_manager is only written to when persist is set
+        self.data_manager = data_manager
+        self.persist = persist
+        self.step_ttls = step_ttls
+        self._states: Dict[int, Tuple[float, dict]] = {}
+    
+    def __len__(self) -> int:
+        return len(self._states)
+    
+    def load(self):
+        """Restore stored conversations, or drop them when persistence is off"""
+        now = time.time()
+        for user_id, state, expires_at in self.data_manager.load_conversations():
+            if self.persist and expires_at > now:
+                self._states[user_id] = (expires_at, state)
+            else:
+                self.data_manager.delete_conversation(user_id)
+    
+    def get(self, user_id: int) -> dict:
+        """Current setup state, or {} if there is none or it expired"""
+        entry = self._states.get(user_id)
+        if entry is None:
+            return {}
+        if entry[0] <= time.time():
+            self.clear(user_id)
+            return {}
+        return entry[1]
+    
+    def set(self, user_id: int, state: dict):
+        """Move a user to a new state, restarting its step's TTL"""
+        expires_at = time.time() + self.step_ttls.get(state.get('step'), CONVERSATION_TTL)
+        self._states[user_id] = (expires_at, state)
+        if self.persist:
+            self.data_manager.save_conversation(user_id, state, expires_at)
+    
+    def clear(self, user_id: int):
+        """End a user's setup"""
+        if self._states.pop(user_id, None) is not None and self.persist:
+            self.data_manager.delete_conversation(user_id)
+    
+    def sweep(self) -> int:
+        """Drop every expired conversation; returns how many were dropped"""
+        now = time.time()
+        expired = [user_id for user_id, (expires_at, _) in self._states.items() if expires_at <= now]
+        for user_id in expired:
+            self.clear(user_id)
+        return len(expired)
+    
+    async def run_sweeper(self, interval: float = CONVERSATION_SWEEP_INTERVAL):
+        """Periodically drop abandoned setups"""
+        while True:
+            await asyncio.sleep(interval)
+            expired = self.sweep()
+            if expired:
+                logger.info(f"Expired {expired} abandoned setup conversations")
+
+
+class AlbumCollector:
+    """Gathers the items of a media album, which arrive as separate messages sharing a grouped_id"""
+    
+    def __init__(self, on_complete, window: float = ALBUM_COLLECT_WINDOW):
+        # on_complete(user_id, messages) runs once an album has been quiet for window seconds
+        self.on_complete = on_complete
+        self.window = window
+        self._albums: Dict[int, Tuple[int, list, asyncio.TimerHandle]] = {}
+    
+    def __len__(self) -> int:
+        return len(self._albums)
+    
+    def add(self, user_id: int, message):
+        """Add an album item and restart the wait; a different album replaces an unfinished one"""
+        album = self._albums.get(user_id)
+        messages = []
+        if album is not None:
+            album[2].cancel()
+            if album[0] == message.grouped_id:
+                messages = album[1]
+        messages.append(message)
+        timer = asyncio.get_running_loop().call_later(self.window, self._complete, user_id)
+        self._albums[user_id] = (message.grouped_id, messages, timer)
+    
+    def discard(self, user_id: int):
+        """Drop the user's unfinished album"""
+        album = self._albums.pop(user_id, None)
+        if album is not None:
+            album[2].cancel()
+    
+    def _complete(self, user_id: int):
+        _, messages, _ = self._albums.pop(user_id)
+        messages.sort(key=lambda message: message.id)
+        asyncio.create_task(self.on_complete(user_id, messages))
+
+# ==================== RATE LIMITING ====================
+class TokenBucket:
+    """Token bucket that hands out reservations instead of blocking"""
+    
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def reserve(self, now: float, amount: float = 1) -> float:
+        """Take amount tokens and return how long to wait before using them"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+    
+    def wait(self, now: float, amount: float = 1) -> float:
+        """How long until amount tokens are available, without taking them"""
+        tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        return max(amount - tokens, 0) / self.rate
+
+
+class UserRateLimiter:
+    """Per-user repeat filter and command token bucket with bounded memory
+    
+    State lives in two generations that rotate every `generation` seconds; a
+    user idle for two generations is dropped with the old map, so memory tracks
+    recently active users rather than every user ever seen.
+    """
+    
+    def __init__(self, window: float = REPEAT_WINDOW, command_rate: float = COMMAND_RATE,
+                 command_burst: float = COMMAND_BURST):
+        self.window = window
+        self.command_rate = command_rate
+        self.command_burst = command_burst
+        # Long enough that dropped state is indistinguishable from fresh state
+        self.generation = max(window, command_burst / command_rate)
+        self._current: Dict[int, list] = {}
+        self._previous: Dict[int, list] = {}
+        self._rotated_at = time.monotonic()
+    
+    def __len__(self) -> int:
+        return len(self._current) + len(self._previous)
+    
+    def _state(self, user_id: int, now: float) -> list:
+        """[last_message, command_tokens, tokens_updated] for a user"""
+        if now - self._rotated_at >= self.generation:
+            stale = now - self._rotated_at >= 2 * self.generation
+            self._previous = {} if stale else self._current
+            self._current = {}
+            self._rotated_at = now
+        
+        state = self._current.get(user_id)
+        if state is None:
+            state = self._previous.pop(user_id, None) or [float('-inf'), self.command_burst, now]
+            self._current[user_id] = state
+        return state
+    
+    def repeat_gap(self, user_id: int) -> Optional[float]:
+        """Seconds since the user's previous message if it is a repeat, else None"""
+        now = time.monotonic()
+        state = self._state(user_id, now)
+        gap = now - state[0]
+        if gap < self.window:
+            return gap
+        state[0] = now
+        return None
+    
+    def allow_command(self, user_id: int) -> bool:
+        """Take a command token for the user"""
+        now = time.monotonic()
+        state = self._state(user_id, now)
+        state[1] = min(self.command_burst, state[1] + (now - state[2]) * self.command_rate)
+        state[2] = now
+        if state[1] < 1:
+            return False
+        state[1] -= 1
+        return True
+
+
+class ForwardRateLimiter:
+    """Global and per-target-chat token buckets that adapt to FloodWaitError"""
+    
+    # Telegram allows about 20 messages a minute per group; an idle chat may take
+    # a minute's worth at once, e.g. a whole album
+    CHAT_BURST = 20
+    
+    def __init__(self, global_rate: float = GLOBAL_FORWARD_RATE, chat_rate: float = CHAT_FORWARD_RATE):
+        self.chat_rate = chat_rate
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.paused_until: Dict[int, float] = {}
+        
+        # Exposed counters
+        self.throttled_seconds: Dict[int, float] = defaultdict(float)
+        self.flood_waits: Dict[int, int] = defaultdict(int)
+    
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.CHAT_BURST)
+        return bucket
+    
+    def pause_remaining(self, chat_id: int) -> float:
+        """Seconds left in the chat's flood-wait window"""
+        return max(self.paused_until.get(chat_id, 0) - time.monotonic(), 0)
+    
+    def wait_remaining(self, chat_id: int, messages: int = 1) -> float:
+        """Seconds until a forward of messages messages to chat_id could go out"""
+        return max(self.pause_remaining(chat_id), self._bucket(chat_id).wait(time.monotonic(), messages))
+    
+    async def acquire(self, chat_id: int, messages: int = 1):
+        """Wait until a forward of messages messages to chat_id is allowed"""
+        # Only this chat sits out its flood wait; the buckets are reserved afterwards
+        # at the real time, since a future timestamp would stall the shared global bucket
+        pause = self.pause_remaining(chat_id)
+        while pause:
+            await asyncio.sleep(pause)
+            pause = self.pause_remaining(chat_id)
+        
+        chat_wait = self._bucket(chat_id).reserve(time.monotonic(), messages)
+        if chat_wait:
+            self.throttled_seconds[chat_id] += chat_wait
+            await asyncio.sleep(chat_wait)
+        
+        # Taken once the chat allows the forward, so other chats aren't throttled
+        # for messages still waiting on this one
+        global_wait = self.global_bucket.reserve(time.monotonic(), messages)
+        if global_wait:
+            self.throttled_seconds[chat_id] += global_wait
+            await asyncio.sleep(global_wait)
+    
+    def on_flood_wait(self, chat_id: int, seconds: int):
+        """Pause the chat for the server-mandated wait and halve its rate"""
+        now = time.monotonic()
+        previous = max(self.paused_until.get(chat_id, 0), now)
+        until = max(previous, now + seconds)
+        self.paused_until[chat_id] = until
+        
+        self.flood_waits[chat_id] += 1
+        self.throttled_seconds[chat_id] += until - previous
+        
+        bucket = self._bucket(chat_id)
+        bucket.rate = max(bucket.rate / 2, self.chat_rate / 16)
+        logger.warning(f"Flood wait of {seconds}s for chat {chat_id}, rate now {bucket.rate:.3f}/s")
+    
+    def on_success(self, chat_id: int):
+        """Recover the chat's rate additively back towards the configured ceiling"""
+        bucket = self._bucket(chat_id)
+        if bucket.rate < self.chat_rate:
+            bucket.rate = min(self.chat_rate, bucket.rate + self.chat_rate / 16)
+        if chat_id in self.paused_until and self.paused_until[chat_id] <= time.monotonic():
+            del self.paused_until[chat_id]
+
+# ==================== SCHEDULER ====================
+class ScheduledTask:
+    """Heap entry for one recurring forwarding task"""
+    
+    __slots__ = ('user_id', 'task_data', 'interval', 'due', 'runs', 'cancelled')
+    
+    def __init__(self, user_id: int, task_data: dict, due: float):
+        self.user_id = user_id
+        self.task_data = task_data
+        self.interval = task_data['interval'] * 3600
+        self.due = due
+        self.runs = 0
+        self.cancelled = False
+    
+    @property
+    def key(self) -> Tuple[int, int]:
+        return self.user_id, self.task_data['id']
+
+
+class ForwardScheduler:
+    """Fires every forwarding task from one min-heap onto a bounded worker pool"""
+    
+    def __init__(self, handler, workers: int = FORWARD_WORKERS, batch_key=None,
+                 coalesce_window: float = FORWARD_COALESCE_WINDOW):
+        # handler receives a list of entries that fired together and share batch_key
+        self.handler = handler
+        self.workers = workers
+        self.batch_key = batch_key
+        self.coalesce_window = coalesce_window
+        self._heap: List[Tuple[float, int, ScheduledTask]] = []
+        self._entries: Dict[Tuple[int, int], ScheduledTask] = {}
+        self._seq = itertools.count()
+        self._cancelled = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def __contains__(self, key: Tuple[int, int]) -> bool:
+        return key in self._entries
+    
+    def keys(self) -> List[Tuple[int, int]]:
+        """(user_id, task_id) of every scheduled task"""
+        return list(self._entries)
+    
+    @property
+    def backlog(self) -> int:
+        """Due tasks waiting for a free worker"""
+        return self._queue.qsize() if self._queue else 0
+    
+    def add(self, user_id: int, task_data: dict, delay: float = 0):
+        """Schedule a task to fire after delay seconds and then every interval"""
+        entry = ScheduledTask(user_id, task_data, time.monotonic() + delay)
+        self.cancel(*entry.key)
+        self._entries[entry.key] = entry
+        heapq.heappush(self._heap, (entry.due, next(self._seq), entry))
+        
+        # Only a new earliest deadline needs to wake the runner early
+        if self._heap[0][2] is entry:
+            self._wakeup.set()
+    
+    def add_many(self, tasks: List[Tuple[int, dict, float]]):
+        """Schedule many (user_id, task_data, delay) at once"""
+        now = time.monotonic()
+        # A few pushes into a large heap beat re-heapifying all of it
+        push = len(tasks) * max(len(self._heap), 1).bit_length() < len(self._heap)
+        for user_id, task_data, delay in tasks:
+            entry = ScheduledTask(user_id, task_data, now + delay)
+            self.cancel(*entry.key)
+            self._entries[entry.key] = entry
+            if push:
+                heapq.heappush(self._heap, (entry.due, next(self._seq), entry))
+            else:
+                self._heap.append((entry.due, next(self._seq), entry))
+        if not push:
+            heapq.heapify(self._heap)
+        self._wakeup.set()
+    
+    def cancel(self, user_id: int, task_id: int) -> bool:
+        """Unschedule a task; its heap slot is discarded lazily"""
+        entry = self._entries.pop((user_id, task_id), None)
+        if entry is None:
+            return False
+        entry.cancelled = True
+        self._cancelled += 1
+        
+        # Rebuild once dead slots dominate so the heap stays proportional to live tasks
+        if self._cancelled > 64 and self._cancelled > len(self._entries):
+            self._heap = [
+                item for item in self._heap
+                if not (isinstance(item[2], ScheduledTask) and item[2].cancelled)
+            ]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+        return True
+    
+    def defer(self, batch: List[ScheduledTask], delay: float):
+        """Retry a batch once after delay seconds, outside the regular schedule"""
+        due = time.monotonic() + delay
+        
+        # Tasks whose next regular tick comes first are left to that tick
+        batch = [entry for entry in batch if entry.due > due]
+        if not batch:
+            return
+        heapq.heappush(self._heap, (due, next(self._seq), batch))
+        if self._heap[0][2] is batch:
+            self._wakeup.set()
+    
+    def start(self):
+        """Start the timer loop and forward workers"""
+        self._queue = asyncio.Queue(maxsize=self.workers * 4)
+        self._tasks.append(asyncio.create_task(self._run()))
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+    
+    def stop(self):
+        """Cancel the timer loop and workers"""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+    
+    def _pop_due(self, now: float) -> Dict[object, List[ScheduledTask]]:
+        """Pop entries due within the coalescing window, grouped by batch key"""
+        batches: Dict[object, List[ScheduledTask]] = {}
+        horizon = now + self.coalesce_window
+        
+        while self._heap and self._heap[0][0] <= horizon:
+            due, seq, entry = heapq.heappop(self._heap)
+            if isinstance(entry, list):
+                # One-shot retry from defer()
+                batches[('retry', seq)] = entry
+                continue
+            if entry.cancelled:
+                self._cancelled -= 1
+                continue
+            
+            # Fixed rate: anchor the next fire on the scheduled time, not on when
+            # the forward finishes; ticks missed entirely are skipped, not bursted
+            entry.due = due + entry.interval
+            if entry.due <= now:
+                entry.due = now + entry.interval
+            heapq.heappush(self._heap, (entry.due, next(self._seq), entry))
+            
+            key = self.batch_key(entry) if self.batch_key else entry.key
+            batches.setdefault(key, []).append(entry)
+        
+        return batches
+    
+    async def _run(self):
+        """Pop due entries, reschedule them at a fixed rate and hand them to workers"""
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            
+            if self._heap and self._heap[0][0] <= now:
+                for batch in self._pop_due(now).values():
+                    await self._queue.put(batch)
+                now = time.monotonic()
+            
+            timeout = max(self._heap[0][0] - now, 0) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def _worker(self):
+        """Run due batches one at a time"""
+        while True:
+            batch = await self._queue.get()
+            try:
+                batch = [entry for entry in batch if not entry.cancelled]
+                for entry in batch:
+                    entry.runs += 1
+                if batch:
+                    await self.handler(batch)
+            except Exception as e:
+                logger.error(f"Tasks {[entry.key for entry in batch]} error: {e}")
+            finally:
+                self._queue.task_done()
+
+# ==================== INBOUND DISPATCH ====================
+class InboundDispatcher:
+    """Runs update handlers on a fixed set of lanes, one worker each; a user always
+    maps to the same lane, so their updates are handled in arrival order"""
     
-    def __init__(self, data_file: str = DATA_FILE):
-        self.data_file = Path(data_file)
-        self.data = self._load_data()
+    def __init__(self, lanes: int = INBOUND_LANES, queue_size: int = INBOUND_QUEUE_SIZE):
+        self.lanes = lanes
+        self.queue_size = queue_size
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
     
-    def _load_data(self) -> dict:
-        """Load data from JSON file"""
-        if self.data_file.exists():
+    @property
+    def backlog(self) -> int:
+        """Updates waiting in every lane"""
+        return sum(lane_queue.qsize() for lane_queue in self._queues)
+    
+    def start(self):
+        """Start the lane workers"""
+        self._queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.lanes)]
+        for lane in range(self.lanes):
+            self._tasks.append(asyncio.create_task(self._worker(lane)))
+    
+    def stop(self):
+        """Cancel the lane workers; later updates are handled inline"""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+        self._queues = []
+    
+    async def dispatch(self, user_id: Optional[int], job):
+        """Queue job, a coroutine function taking no arguments, on the user's lane"""
+        if not self._queues:
+            await job()
+            return
+        lane = hash(user_id) % self.lanes
+        lane_queue = self._queues[lane]
+        if lane_queue.full():
+            # Telethon runs each update in its own task, so waiting here holds
+            # back only this update; the queue's putters keep their order
+            INBOUND_BACKPRESSURE.inc()
+        await lane_queue.put((job, time.perf_counter()))
+        INBOUND_QUEUE_DEPTH.set(lane_queue.qsize(), str(lane))
+    
+    async def _worker(self, lane: int):
+        """Run one lane's updates one at a time"""
+        lane_queue = self._queues[lane]
+        while True:
+            job, queued_at = await lane_queue.get()
+            INBOUND_QUEUE_DEPTH.set(lane_queue.qsize(), str(lane))
+            INBOUND_WAIT.observe(time.perf_counter() - queued_at)
             try:
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except (json.JSONDecodeError, IOError) as e:
-                logger.error(f"Error loading data: {e}")
-                return {}
-        return {}
+                await job()
+            except Exception as e:
+                logger.error(f"Update handler error on lane {lane}: {e}", exc_info=True)
+
+# ==================== SHARDING ====================
+class ShardCoordinator:
+    """Tracks one worker's position among the live shard workers"""
     
-    def save_data(self):
-        """Save data to JSON file"""
-        try:
-            with open(self.data_file, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, indent=2, ensure_ascii=False)
-        except IOError as e:
-            logger.error(f"Error saving data: {e}")
+    def __init__(self, data_manager: 'SQLiteDataManager', worker_id: str):
+        self.data_manager = data_manager
+        self.worker_id = worker_id
+        self.index = 0
+        self.count = 0
     
-    def get_user_state(self, user_id: int) -> dict:
-        """Get user's current state"""
-        return self.data.get(str(user_id), {})
+    def refresh(self) -> bool:
+        """Send a heartbeat and recompute the partition; True when it changed"""
+        self.data_manager.heartbeat_worker(self.worker_id)
+        # Our own heartbeat was just written, so we are always a member
+        workers = self.data_manager.get_live_workers()
+        position = (workers.index(self.worker_id), len(workers))
+        changed = position != (self.index, self.count)
+        self.index, self.count = position
+        return changed
     
-    def set_user_state(self, user_id: int, state: dict):
-        """Set user's state"""
-        self.data[str(user_id)] = state
-        self.save_data()
+    def owned_tasks(self) -> Iterator[Tuple[int, dict]]:
+        """Active tasks in this worker's shard"""
+        return self.data_manager.get_shard_tasks(self.index, self.count)
     
-    def clear_user_state(self, user_id: int):
-        """Clear user's state"""
-        if str(user_id) in self.data:
-            del self.data[str(user_id)]
-            self.save_data()
+    def leave(self):
+        """Drop out of membership so the other workers rebalance immediately"""
+        self.data_manager.remove_worker(self.worker_id)
+
+
+class ShardSupervisor:
+    """Runs the shard worker processes and restarts any that exit"""
     
-    def add_forwarding_task(self, user_id: int, task_data: dict):
-        """Add a forwarding task for user"""
-        tasks = self.data.setdefault('tasks', {})
-        user_tasks = tasks.setdefault(str(user_id), [])
-        task_data['id'] = len(user_tasks) + 1
-        task_data['created_at'] = datetime.now().isoformat()
-        task_data['last_forward'] = datetime.now().isoformat()
-        task_data['forward_count'] = 0
-        user_tasks.append(task_data)
-        self.save_data()
-        return task_data['id']
+    def __init__(self, workers: int = SHARD_WORKERS):
+        self.workers = workers
+        # Spawn gives each worker a fresh interpreter instead of a fork of this event loop
+        self._context = multiprocessing.get_context('spawn')
+        self.processes: Dict[int, multiprocessing.Process] = {}
     
-    def get_user_tasks(self, user_id: int) -> List[dict]:
-        """Get all tasks for a user"""
-        return self.data.get('tasks', {}).get(str(user_id), [])
+    def _spawn(self, slot: int):
+        """Start the worker process for slot"""
+        process = self._context.Process(
+            target=run_worker, args=(slot,), name=f"shard-worker-{slot}", daemon=True
+        )
+        process.start()
+        self.processes[slot] = process
+        logger.info(f"Started shard worker {slot} (pid {process.pid})")
     
-    def remove_task(self, user_id: int, task_id: int):
-        """Remove a specific task"""
-        tasks = self.data.get('tasks', {}).get(str(user_id), [])
-        if tasks:
-            self.data['tasks'][str(user_id)] = [t for t in tasks if t.get('id') != task_id]
-            self.save_data()
+    async def run(self):
+        """Start every worker, then restart the ones that exit"""
+        for slot in range(self.workers):
+            self._spawn(slot)
+        while True:
+            await asyncio.sleep(SHARD_SYNC_INTERVAL)
+            for slot, process in list(self.processes.items()):
+                if not process.is_alive():
+                    logger.warning(f"Shard worker {slot} exited with code {process.exitcode}, restarting")
+                    self._spawn(slot)
     
-    def update_task_last_forward(self, user_id: int, task_id: int):
-        """Update last forward time and count for task"""
-        tasks = self.data.get('tasks', {}).get(str(user_id), [])
-        if tasks:
-            for task in tasks:
-                if task.get('id') == task_id:
-                    task['last_forward'] = datetime.now().isoformat()
-                    task['forward_count'] = task.get('forward_count', 0) + 1
-                    self.save_data()
-                    break
+    def stop(self):
+        """Ask every worker to shut down and wait for them"""
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=10)
 
 # ==================== BOT CORE ====================
+class BotStatus(NamedTuple):
+    """Immutable status snapshot published by the bot loop for other threads"""
+    username: Optional[str] = None
+    connected: bool = False
+    active_tasks: int = 0
+    last_forward: Optional[str] = None
+    scheduler_backlog: int = 0
+    updated_at: float = 0.0
+
+
+class ForwardResult(NamedTuple):
+    """Outcome of one task's forward attempt"""
+    success: bool
+    message: str
+    # 'success' or the error class, as counted by FORWARD_RESULTS
+    outcome: str
+    # Seconds the forwardMessages request took, without rate limiting or flood waits
+    latency: float
+
+
+# Invite links, public links and numeric IDs, matched in a single pass over a setup message.
+# An ID must be a whole token of 5+ digits (e.g. -100...) separated by whitespace,
+# commas or semicolons, so counts and other numbers in free text aren't taken for chats.
+GROUP_REF_RE = re.compile(
+    r'(?:https?://)?t\.me/(?:\+|joinchat/)(?P<invite>[a-zA-Z0-9_-]+)'
+    r'|(?:https?://)?t\.me/(?P<username>[a-zA-Z0-9_]+)'
+    r'|(?<![^\s,;])(?P<chat_id>-?\d{5,})(?![^\s,;])'
+)
+
+
 class PrivateChatOnlyBot:
     """Bot that only works in private chats with no repeated messages"""
     
-    def __init__(self, api_id: str, api_hash: str, bot_token: str):
-        self.client = TelegramClient(SESSION_FILE, api_id, api_hash)
+    def __init__(self, api_id: str, api_hash: str, bot_token: str,
+                 role: str = 'standalone', session: str = SESSION_FILE, client=None,
+                 ledger_file: str = LEDGER_FILE):
+        # 'standalone' chats and forwards, 'front' only chats and each
+        # 'worker' only forwards its shard of the tasks (see ShardSupervisor)
+        self.role = role
+        self.startup = StartupTimer()
+        self.startup.mark('imports')
+        # client may be any TelegramClient stand-in, e.g. benchmark.FakeTelegramClient
+        self.client = client or TelegramClient(session, api_id, api_hash, receive_updates=role != 'worker')
         self.bot_token = bot_token
-        self.data_manager = DataManager()
-        self.active_tasks: Dict[int, asyncio.Task] = {}
-        self.message_store: Dict[int, dict] = {}
+        self.session_file = session
+        self.startup.mark('session load')
+        if role == 'standalone':
+            self.data_manager = create_data_manager()
+        else:
+            # Shard processes share one database, importing DATA_FILE on first use
+            self.data_manager = create_data_manager('sqlite', write_behind=False)
+        self.conversations = ConversationManager(self.data_manager)
+        self.albums = AlbumCollector(self.handle_album)
+        # Workers only track their own shard (see sync_shard_tasks)
+        self.tasks = TaskRegistry(self.data_manager)
+        if role != 'worker':
+            self.conversations.load()
+            self.tasks.load()
+        self.startup.mark('data load')
+        self.ledger = ForwardLedger(ledger_file)
+        # Tasks stopped while the background restore is running
+        self.restoring = False
+        self.restore_skip: set = set()
+        self.shard: Optional[ShardCoordinator] = None
+        self.scheduler = ForwardScheduler(
+            self.run_scheduled_forwards,
+            batch_key=lambda entry: (entry.user_id, entry.task_data['target_chat_id'])
+        )
+        self.maintenance_tasks: List[asyncio.Task] = []
+        
+        # Replaced wholesale by publish_status(); web threads only ever read it
+        self.status = BotStatus()
+        self.last_forward_at: Optional[datetime] = None
+        self.message_store = MessageStore(self.data_manager)
+        self.source_messages = LRUCache(SOURCE_CACHE_SIZE)
+        self.rate_limiter = ForwardRateLimiter()
+        self.resolve_cache = AsyncTTLCache(RESOLVE_CACHE_TTL, RESOLVE_CACHE_SIZE)
         
-        # Store last message time per user to prevent repeats
-        self.user_last_message: Dict[int, float] = {}
+        # Per-user repeat filter and command rate limit
+        self.user_limiter = UserRateLimiter()
+        self.inbound = InboundDispatcher()
+        self.profiler = Profiler()
         
-        # Register event handlers with filters
-        self.client.add_event_handler(
+        if role != 'worker':
+            self.register_handlers()
+    
+    def register_handlers(self):
+        """Register event handlers with filters"""
+        self.add_handler(
             self.handle_start, 
-            events.NewMessage(pattern='/start', incoming=True, func=self.is_private_chat)
+            events.NewMessage(pattern='/start', incoming=True, func=self.is_private_command)
         )
-        self.client.add_event_handler(
+        self.add_handler(
             self.handle_cancel, 
-            events.NewMessage(pattern='/cancel', incoming=True, func=self.is_private_chat)
+            events.NewMessage(pattern='/cancel', incoming=True, func=self.is_private_command)
         )
-        self.client.add_event_handler(
+        self.add_handler(
             self.handle_my_tasks, 
-            events.NewMessage(pattern='/mytasks', incoming=True, func=self.is_private_chat)
+            events.NewMessage(pattern='/mytasks', incoming=True, func=self.is_private_command)
         )
-        self.client.add_event_handler(
+        self.add_handler(
             self.handle_stop_task, 
-            events.NewMessage(pattern='/stoptask', incoming=True, func=self.is_private_chat)
+            events.NewMessage(pattern='/stoptask', incoming=True, func=self.is_private_command)
         )
-        self.client.add_event_handler(
+        self.add_handler(
             self.handle_status, 
-            events.NewMessage(pattern='/status', incoming=True, func=self.is_private_chat)
+            events.NewMessage(pattern='/status', incoming=True, func=self.is_private_command)
         )
-        self.client.add_event_handler(
+        self.add_handler(
             self.handle_help, 
-            events.NewMessage(pattern='/help', incoming=True, func=self.is_private_chat)
+            events.NewMessage(pattern='/help', incoming=True, func=self.is_private_command)
+        )
+        self.add_handler(
+            self.handle_profile,
+            events.NewMessage(pattern='/profile', incoming=True, func=self.is_private_command)
         )
-        self.client.add_event_handler(
+        self.add_handler(
             self.handle_message,
             events.NewMessage(incoming=True, func=self.is_private_chat_and_not_command)
         )
     
+    def add_handler(self, handler, event_builder):
+        """Register an event handler with latency instrumentation"""
+        name = handler.__name__
+        
+        async def instrumented(event):
+            # The handler may move the user on, so note the step it started from
+            step = self.conversations.get(event.sender_id).get('step')
+            started = time.perf_counter()
+            try:
+                await handler(event)
+            finally:
+                elapsed = time.perf_counter() - started
+                HANDLER_LATENCY.observe(elapsed, name)
+                if elapsed > SLOW_CALL_THRESHOLD:
+                    logger.warning(f"Slow {name}: {elapsed:.2f}s for user {event.sender_id} (step: {step})")
+        
+        async def dispatch(event):
+            # Filters have already run in Telethon's update task; the handler runs on the user's lane
+            await self.inbound.dispatch(event.sender_id, lambda: instrumented(event))
+        
+        self.client.add_event_handler(dispatch, event_builder)
+    
     def is_private_chat(self, event):
         """Check if message is from private chat"""
         return event.is_private
     
+    def is_private_command(self, event):
+        """Check if command is from private chat and within the user's command rate"""
+        if not event.is_private:
+            return False
+        
+        if not self.user_limiter.allow_command(event.sender_id):
+            filter_logger.info(f"Ignoring command from user {event.sender_id}: rate limited",
+                               extra={'user_id': event.sender_id})
+            return False
+        return True
+    
     def is_private_chat_and_not_command(self, event):
         """Check if message is from private chat and not a command"""
         if not event.is_private:
@@ -184,69 +2358,111 @@ class PrivateChatOnlyBot:
         if event.raw_text and event.raw_text.startswith('/'):
             return False
         
-        # Prevent repeated messages from same user
+        # An album's items arrive within the repeat window; while a setup waits for
+        # its message they are all let through for the AlbumCollector. This runs before
+        # the lane handles the first item, so it can't wait for the collector to see it.
         user_id = event.sender_id
-        current_time = datetime.now().timestamp()
-        
-        # Check if user sent a message recently (within 2 seconds)
-        if user_id in self.user_last_message:
-            time_diff = current_time - self.user_last_message[user_id]
-            if time_diff < 2:  # Less than 2 seconds
-                logger.info(f"Ignoring repeated message from user {user_id} within {time_diff:.2f}s")
-                return False
+        if (event.message and event.message.grouped_id
+                and self.conversations.get(user_id).get('step') == 'awaiting_message'):
+            return True
         
-        # Update last message time
-        self.user_last_message[user_id] = current_time
+        # Prevent repeated messages from same user
+        time_diff = self.user_limiter.repeat_gap(user_id)
+        if time_diff is not None:
+            filter_logger.info(f"Ignoring repeated message from user {user_id} within {time_diff:.2f}s",
+                               extra={'user_id': user_id})
+            return False
         return True
     
     # ==================== UTILITY METHODS ====================
     
+    async def get_me(self):
+        """Bot's own user, fetched once"""
+        return await self.resolve_cache.get(('me',), self.client.get_me, ttl=86400)
+    
+    async def resolve_entity(self, peer):
+        """Cached get_entity by username or ID"""
+        entity = await self.resolve_cache.get(('entity', peer), lambda: self.client.get_entity(peer))
+        # Later lookups by the resolved ID hit the same entry
+        self.resolve_cache.put(('entity', abs(entity.id)), entity)
+        return entity
+    
+    async def target_peer(self, chat_id: int) -> dict:
+        """Marked peer ID and access hash of a verified target, as stored in its tasks"""
+        try:
+            # Verification put the target in this session, so this is a local lookup
+            peer = await self.client.get_input_entity(chat_id)
+        except Exception as e:
+            logger.warning(f"Cannot resolve target {chat_id}; shard workers may not reach it: {e}")
+            return {}
+        return {'target_peer': utils.get_peer_id(peer), 'target_access_hash': getattr(peer, 'access_hash', None)}
+    
+    async def resolve_invite(self, invite_hash: str):
+        """Cached CheckChatInviteRequest"""
+        return await self.resolve_cache.get(
+            ('invite', invite_hash),
+            lambda: self.client(CheckChatInviteRequest(invite_hash))
+        )
+    
+    async def is_participant(self, entity) -> bool:
+        """Cached check that the bot is a member of a channel or supergroup"""
+        async def fetch():
+            try:
+                await self.client(GetParticipantRequest(channel=entity, participant=await self.get_me()))
+                return True
+            except UserNotParticipantError:
+                return False
+        
+        key = ('participant', abs(entity.id))
+        member = await self.resolve_cache.get(key, fetch)
+        if not member:
+            # Only membership is remembered; the user is likely to add the bot and retry
+            self.resolve_cache.invalidate(key)
+        return member
+    
+    def parse_group_inputs(self, text: str) -> List[str]:
+        """Extract distinct group references from a message"""
+        refs = []
+        for match in GROUP_REF_RE.finditer(text):
+            if match.group('invite'):
+                refs.append(f"t.me/+{match.group('invite')}")
+            elif match.group('username'):
+                refs.append(f"t.me/{match.group('username')}")
+            else:
+                refs.append(match.group('chat_id'))
+        return list(dict.fromkeys(refs))
+    
     async def extract_group_info(self, group_input: str) -> Optional[Tuple[int, str, str]]:
         """Extract group info from input"""
         try:
-            group_input = group_input.strip()
+            match = GROUP_REF_RE.search(group_input.strip())
+            if not match:
+                return None, None, None
             
             # Check if it's an invite link
-            if 't.me/+' in group_input or 't.me/joinchat/' in group_input:
-                patterns = [
-                    r't\.me/\+([a-zA-Z0-9_-]+)',
-                    r't\.me/joinchat/([a-zA-Z0-9_-]+)',
-                    r'https?://t\.me/(?:\+joinchat/|joinchat/)?([a-zA-Z0-9_-]+)'
-                ]
-                
-                invite_hash = None
-                for pattern in patterns:
-                    match = re.search(pattern, group_input)
-                    if match:
-                        invite_hash = match.group(1)
-                        break
-                
-                if invite_hash:
-                    try:
-                        invite = await self.client(CheckChatInviteRequest(invite_hash))
-                        if isinstance(invite, types.ChatInvite):
-                            return None, invite.title, invite_hash
-                        elif isinstance(invite, types.ChatInviteAlready):
-                            return invite.chat.id, invite.chat.title, None
-                    except:
-                        return None, None, invite_hash
+            if match.group('invite'):
+                invite_hash = match.group('invite')
+                try:
+                    invite = await self.resolve_invite(invite_hash)
+                    if isinstance(invite, types.ChatInvite):
+                        return None, invite.title, invite_hash
+                    elif isinstance(invite, types.ChatInviteAlready):
+                        return invite.chat.id, invite.chat.title, None
+                except:
+                    return None, None, invite_hash
             
             # Handle regular group/channel link
-            elif 't.me/' in group_input:
-                match = re.search(r't\.me/([a-zA-Z0-9_]+)', group_input)
-                if match:
-                    username = match.group(1)
-                    try:
-                        entity = await self.client.get_entity(username)
-                        return abs(entity.id), entity.title, None
-                    except:
-                        return None, None, None
+            elif match.group('username'):
+                try:
+                    entity = await self.resolve_entity(match.group('username'))
+                    return abs(entity.id), entity.title, None
+                except:
+                    return None, None, None
             
             # Handle numeric ID
-            elif group_input.lstrip('-').isdigit():
-                group_id = int(group_input)
+            else:
                 try:
-                    entity = await self.client.get_entity(group_id)
+                    entity = await self.resolve_entity(int(match.group('chat_id')))
                     return abs(entity.id), entity.title, None
                 except:
                     return None, None, None
@@ -257,6 +2473,16 @@ class PrivateChatOnlyBot:
             logger.error(f"Error extracting group info: {e}")
             return None, None, None
     
+    async def verify_groups(self, group_inputs: List[str]) -> List[Tuple[bool, str, Optional[int], Optional[str]]]:
+        """Verify several groups concurrently, at most VERIFY_CONCURRENCY at a time"""
+        semaphore = asyncio.Semaphore(VERIFY_CONCURRENCY)
+        
+        async def verify(group_input: str):
+            async with semaphore:
+                return await self.verify_group_membership(group_input)
+        
+        return await asyncio.gather(*(verify(group_input) for group_input in group_inputs))
+    
     async def verify_group_membership(self, group_input: str) -> Tuple[bool, str, Optional[int], Optional[str]]:
         """Verify bot is a member of the group"""
         try:
@@ -265,7 +2491,7 @@ class PrivateChatOnlyBot:
             if invite_hash:
                 # Private group invite
                 try:
-                    invite = await self.client(CheckChatInviteRequest(invite_hash))
+                    invite = await self.resolve_invite(invite_hash)
                     
                     if isinstance(invite, types.ChatInviteAlready):
                         return True, f"✅ Already a member of **{invite.chat.title}**", invite.chat.id, invite.chat.title
@@ -273,6 +2499,7 @@ class PrivateChatOnlyBot:
                     elif isinstance(invite, types.ChatInvite):
                         try:
                             result = await self.client(ImportChatInviteRequest(invite_hash))
+                            self.resolve_cache.invalidate(('invite', invite_hash))
                             for update in result.updates:
                                 if hasattr(update, 'chat_id'):
                                     return True, f"✅ Successfully joined **{invite.title}**", update.chat_id, invite.title
@@ -289,20 +2516,17 @@ class PrivateChatOnlyBot:
             elif chat_id:
                 # Public group/channel
                 try:
-                    entity = await self.client.get_entity(chat_id)
+                    entity = await self.resolve_entity(chat_id)
                     
                     # Check if we're a participant
-                    try:
-                        await self.client(GetParticipantRequest(
-                            channel=entity,
-                            participant=await self.client.get_me()
-                        ))
+                    if await self.is_participant(entity):
                         return True, f"✅ **Group verified:** {chat_title}", chat_id, chat_title
-                    except UserNotParticipantError:
+                    else:
                         # Try to join if public
                         if hasattr(entity, 'username') and entity.username:
                             try:
                                 await self.client(JoinChannelRequest(entity))
+                                self.resolve_cache.put(('participant', abs(entity.id)), True)
                                 return True, f"✅ **Joined group:** {chat_title}", chat_id, chat_title
                             except Exception as e:
                                 return False, f"❌ **Cannot join group:** {str(e)}", None, None
@@ -319,15 +2543,19 @@ class PrivateChatOnlyBot:
             logger.error(f"Error in verify_group_membership: {e}")
             return False, f"❌ **Error:** {str(e)}", None, None
     
-    def store_message_data(self, message: types.Message) -> dict:
+    def store_message_data(self, user_id: int, message: types.Message) -> dict:
         """Store message data"""
+        # Plain values only; live TL objects would pin the whole message in memory
         message_data = {
             'id': message.id,
             'text': message.text or message.message,
             'media': None,
             'forward': None,
             'date': message.date.isoformat() if message.date else None,
-            'entities': message.entities
+            'entities': [
+                [type(entity).__name__, entity.offset, entity.length]
+                for entity in message.entities or []
+            ]
         }
         
         if message.media:
@@ -342,90 +2570,236 @@ class PrivateChatOnlyBot:
                 'date': message.forward.date.isoformat() if message.forward.date else None,
             }
         
-        self.message_store[message.id] = message_data
+        self.message_store.put(user_id, message.id, message_data)
         return message_data
     
-    async def forward_message(self, task_data: dict) -> Tuple[bool, str]:
-        """Forward a message to target chat"""
-        try:
-            user_id = task_data['user_id']
-            source_msg_id = task_data['source_msg_id']
-            target_chat_id = task_data['target_chat_id']
+    def message_preview(self, user_id: int, message_id: int) -> str:
+        """Short description of a stored source message"""
+        record = self.message_store.get(user_id, message_id)
+        if record is None:
+            return "Unknown"
+        if record.get('text'):
+            text = record['text'].replace('\n', ' ')
+            return text[:40] + ('…' if len(text) > 40 else '')
+        if record.get('media'):
+            return record['media']['type'].replace('MessageMedia', '') or 'Media'
+        return "Message"
+    
+    async def forward_batch(self, tasks: List[dict]) -> List[Optional[ForwardResult]]:
+        """Forward the source messages of tasks sharing a user and target chat
+        
+        A None result means the forward was not attempted because the target chat's
+        flood wait or rate limit would hold it for longer than FLOOD_WAIT_INLINE_MAX.
+        """
+        target_chat_id = tasks[0]['target_chat_id']
+        results: List[Optional[ForwardResult]] = [None] * len(tasks)
+        pending = list(range(len(tasks)))
+        # A request larger than the chat's bucket could never go out
+        batch_size = min(FORWARD_BATCH_SIZE, ForwardRateLimiter.CHAT_BURST)
+        
+        # Each request carries distinct message IDs, so two tasks forwarding the
+        # same message still post it twice, as they would have separately. An
+        # album's items always go out together so Telegram keeps them grouped.
+        while pending:
+            chunk, rest, seen = [], [], set()
+            for i in pending:
+                msg_ids = TaskRegistry.message_ids(tasks[i])
+                if chunk and (seen.intersection(msg_ids) or len(seen) + len(msg_ids) > batch_size):
+                    rest.append(i)
+                else:
+                    chunk.append(i)
+                    seen.update(msg_ids)
             
-            # Get the original message
-            messages = await self.client.get_messages(user_id, ids=source_msg_id)
-            if not messages:
-                return False, "❌ **Source message not found!**"
+            # Long waits are left to the caller to defer instead of holding a worker
+            if self.rate_limiter.wait_remaining(target_chat_id, len(seen)) > FLOOD_WAIT_INLINE_MAX:
+                break
             
-            # Forward with original sender preserved
-            await self.client.forward_messages(
-                entity=target_chat_id,
-                messages=messages,
-                drop_author=False,  # Preserve original sender
-                silent=True
-            )
-            return True, "✅ **Forwarded successfully!**"
+            try:
+                chunk_results = await self._forward_chunk([tasks[i] for i in chunk])
+            except FloodWaitError:
+                # The chat is paused; this chunk and everything after it waits
+                break
+            for i, result in zip(chunk, chunk_results):
+                results[i] = result
+            if None in chunk_results:
+                # A flood wait stopped the chunk part way; the rest waits too
+                break
+            pending = rest
+        
+        return results
+    
+    async def _forward_chunk(self, tasks: List[dict]) -> List[Optional[ForwardResult]]:
+        """Forward distinct source messages to one target in a single request; None
+        marks tasks a flood wait kept back after the others were retried singly"""
+        user_id = tasks[0]['user_id']
+        target_chat_id = tasks[0]['target_chat_id']
+        cache_keys = [(user_id, msg_id) for task in tasks for msg_id in TaskRegistry.message_ids(task)]
+        # Only the request itself counts as latency, not rate limiting or flood waits
+        rpc_times: List[float] = []
         
-        except FloodWaitError as e:
-            return False, f"⏳ **Flood wait:** {e.seconds} seconds"
+        try:
+            # Cached Message objects and bare IDs from the same chat go out together
+            forwarded = await self._send_forward(
+                target_chat_id,
+                TaskRegistry.input_peer(tasks[0]),
+                user_id,
+                [self.source_messages.get(key) or key[1] for key in cache_keys],
+                rpc_times
+            )
+        except MessageIdInvalidError:
+            if len(tasks) > 1:
+                # One deleted source must not fail the others; isolate it. A flood
+                # wait holds back the tasks after it but not those already sent.
+                results: List[Optional[ForwardResult]] = [None] * len(tasks)
+                for i, task in enumerate(tasks):
+                    try:
+                        results[i] = (await self._forward_chunk([task]))[0]
+                    except FloodWaitError:
+                        break
+                return results
+            for key in cache_keys:
+                self.source_messages.invalidate(key)
+            FORWARD_RESULTS.inc('MessageIdInvalidError')
+            return [ForwardResult(False, "❌ **Source message not found!**", 'MessageIdInvalidError',
+                                  rpc_times[-1])]
+        except FloodWaitError:
+            raise
         except ChatWriteForbiddenError:
-            return False, "❌ **Bot cannot send messages in this chat!**"
+            FORWARD_RESULTS.inc('ChatWriteForbiddenError', amount=len(tasks))
+            logger.warning(f"Cannot send to chat {target_chat_id}; "
+                           f"{len(self.tasks.chat_tasks(target_chat_id))} tasks target it")
+            return [ForwardResult(False, "❌ **Bot cannot send messages in this chat!**", 'ChatWriteForbiddenError',
+                                  rpc_times[-1])] * len(tasks)
         except Exception as e:
             logger.error(f"Forward error: {e}")
-            return False, f"❌ **Error:** {str(e)}"
+            FORWARD_RESULTS.inc(type(e).__name__, amount=len(tasks))
+            # Errors can come from before the request, e.g. the rate limiter
+            return [ForwardResult(False, f"❌ **Error:** {str(e)}", type(e).__name__,
+                                  rpc_times[-1] if rpc_times else 0.0)] * len(tasks)
+        
+        latency = rpc_times[-1]
+        self.rate_limiter.on_success(target_chat_id)
+        sent = dict(zip(cache_keys, forwarded or [None] * len(cache_keys)))
+        results = []
+        for task in tasks:
+            keys = [(user_id, msg_id) for msg_id in TaskRegistry.message_ids(task)]
+            for key in keys:
+                if not sent[key]:
+                    self.source_messages.invalidate(key)
+            # An album with some items deleted is still delivered
+            if any(sent[key] for key in keys):
+                FORWARD_RESULTS.inc('success')
+                results.append(ForwardResult(True, "✅ **Forwarded successfully!**", 'success', latency))
+            else:
+                FORWARD_RESULTS.inc('MessageNotFound')
+                results.append(ForwardResult(False, "❌ **Source message not found!**", 'MessageNotFound', latency))
+        return results
+    
+    async def _send_forward(self, target_chat_id: int, peer, from_peer: int, messages: list,
+                            rpc_times: Optional[List[float]] = None):
+        """Rate-limited forward_messages to peer that waits out short flood waits and
+        retries; the duration of each request made is appended to rpc_times"""
+        for attempt in range(FLOOD_WAIT_RETRIES + 1):
+            # Telegram's limits count messages, and one request may carry many
+            await self.rate_limiter.acquire(target_chat_id, len(messages))
+            started = time.perf_counter()
+            try:
+                return await self.client.forward_messages(
+                    entity=peer,
+                    messages=messages,
+                    from_peer=from_peer,
+                    drop_author=False,  # Preserve original sender
+                    silent=True
+                )
+            except FloodWaitError as e:
+                FLOOD_WAITS.inc()
+                FLOOD_WAIT_SECONDS.inc(amount=e.seconds)
+                self.rate_limiter.on_flood_wait(target_chat_id, e.seconds)
+                if e.seconds > FLOOD_WAIT_INLINE_MAX or attempt == FLOOD_WAIT_RETRIES:
+                    raise
+            finally:
+                elapsed = time.perf_counter() - started
+                FORWARD_LATENCY.observe(elapsed)
+                if rpc_times is not None:
+                    rpc_times.append(elapsed)
     
     # ==================== TASK MANAGEMENT ====================
     async def start_forwarding_task(self, user_id: int, task_data: dict):
         """Start a forwarding task with interval"""
-        task_id = task_data['id']
-        interval_hours = task_data['interval']
-        target_chat_title = task_data['target_chat_title']
+        if self.role == 'front':
+            # The owning shard worker picks it up from storage on its next sync
+            logger.info(f"Queued task {task_data['id']} for user {user_id} for shard workers",
+                        extra={'user_id': user_id, 'task_id': task_data['id']})
+            return
+        self.scheduler.add(user_id, task_data)
+        logger.info(f"Started task {task_data['id']} for user {user_id}",
+                    extra={'user_id': user_id, 'task_id': task_data['id']})
+    
+    async def run_scheduled_forwards(self, entries: List[ScheduledTask]):
+        """Forward a batch of due tasks; called by the scheduler's workers"""
+        target_chat_id = entries[0].task_data['target_chat_id']
+        throttled = self.rate_limiter.throttled_seconds.get(target_chat_id, 0)
+        started = time.perf_counter()
+        try:
+            await self.forward_entries(target_chat_id, entries)
+        finally:
+            elapsed = time.perf_counter() - started
+            FORWARD_BATCH_LATENCY.observe(elapsed)
+            # Waiting on the rate limiter is expected; only the remainder counts as slow
+            working = elapsed - (self.rate_limiter.throttled_seconds.get(target_chat_id, 0) - throttled)
+            if working > SLOW_CALL_THRESHOLD:
+                logger.warning(f"Slow forward of {len(entries)} tasks to chat {target_chat_id}: "
+                               f"{elapsed:.2f}s ({working:.2f}s excluding rate limits)")
+    
+    @staticmethod
+    def batch_messages(entries: List[ScheduledTask]) -> int:
+        """Messages forward_batch would put in its first request for entries, at most"""
+        return min(sum(len(TaskRegistry.message_ids(entry.task_data)) for entry in entries),
+                   FORWARD_BATCH_SIZE, ForwardRateLimiter.CHAT_BURST)
+    
+    async def forward_entries(self, target_chat_id: int, entries: List[ScheduledTask]):
+        """Forward entries sharing a target, deferring what a flood wait or rate limit blocks"""
+        # Don't hold a worker for a long wait; come back when it ends
+        wait = self.rate_limiter.wait_remaining(target_chat_id, self.batch_messages(entries))
+        if wait > FLOOD_WAIT_INLINE_MAX:
+            self.scheduler.defer(entries, wait)
+            return
         
-        async def task_loop():
-            try:
-                forward_count = 0
-                
-                while True:
-                    success, result_msg = await self.forward_message(task_data)
-                    forward_count += 1
-                    
-                    if success:
-                        logger.info(f"Task {task_id}: Forward #{forward_count} successful")
-                        self.data_manager.update_task_last_forward(user_id, task_id)
-                    else:
-                        logger.warning(f"Task {task_id}: Forward #{forward_count} failed - {result_msg}")
-                    
-                    # Wait for next interval
-                    await asyncio.sleep(interval_hours * 3600)
-                    
-            except asyncio.CancelledError:
-                logger.info(f"Task {task_id} cancelled")
-            except Exception as e:
-                logger.error(f"Task {task_id} error: {e}")
+        results = await self.forward_batch([entry.task_data for entry in entries])
+        
+        deferred = [entry for entry, result in zip(entries, results) if result is None]
+        if deferred:
+            wait = self.rate_limiter.wait_remaining(target_chat_id, self.batch_messages(deferred))
+            logger.warning(f"Deferring {len(deferred)} forwards to chat {target_chat_id} by {wait:.0f}s "
+                           f"(flood wait or rate limit)")
+            self.scheduler.defer(deferred, wait)
         
-        # Create and store the task
-        task = asyncio.create_task(task_loop())
-        self.active_tasks[task_id] = task
-        logger.info(f"Started task {task_id} for user {user_id}")
+        for entry, result in zip(entries, results):
+            task_id = entry.task_data['id']
+            if result is None:
+                self.ledger.record(entry.user_id, task_id, target_chat_id, 'deferred')
+                continue
+            self.ledger.record(entry.user_id, task_id, target_chat_id, result.outcome, result.latency)
+            self.tasks.record_attempt(entry.user_id, task_id, result.outcome, result.latency)
+            context = {'user_id': entry.user_id, 'task_id': task_id, 'chat_id': target_chat_id}
+            if result.success:
+                forward_logger.info(f"Task {task_id}: Forward #{entry.runs} successful", extra=context)
+                self.last_forward_at = datetime.now()
+            else:
+                forward_logger.warning(f"Task {task_id}: Forward #{entry.runs} failed - {result.message}",
+                                       extra=context)
     
     async def stop_task_by_id(self, user_id: int, task_id: int) -> bool:
         """Stop a specific forwarding task"""
-        if task_id in self.active_tasks:
-            self.active_tasks[task_id].cancel()
-            del self.active_tasks[task_id]
-            
-            # Update task status in storage
-            tasks = self.data_manager.get_user_tasks(user_id)
-            for task in tasks:
-                if task.get('id') == task_id:
-                    task['status'] = 'stopped'
-                    task['stopped_at'] = datetime.now().isoformat()
-                    break
-            self.data_manager.save_data()
-            
-            logger.info(f"Stopped task {task_id} for user {user_id}")
-            return True
-        return False
+        # The registry decides; in sharded mode the task is scheduled in a worker
+        if not self.tasks.set_status(user_id, task_id, 'stopped', stopped_at=datetime.now().isoformat()):
+            return False
+        if not self.scheduler.cancel(user_id, task_id) and self.restoring:
+            # Not restored yet; make sure the restore doesn't schedule it
+            self.restore_skip.add((user_id, task_id))
+        
+        logger.info(f"Stopped task {task_id} for user {user_id}", extra={'user_id': user_id, 'task_id': task_id})
+        return True
     
     # ==================== COMMAND HANDLERS ====================
     async def handle_start(self, event):
@@ -433,7 +2807,8 @@ class PrivateChatOnlyBot:
         user_id = event.sender_id
         
         # Clear any existing state
-        self.data_manager.clear_user_state(user_id)
+        self.conversations.clear(user_id)
+        self.albums.discard(user_id)
         
         welcome_text = """
 🤖 **Welcome to Private Auto-Forwarder Bot!** 🤖
@@ -464,22 +2839,24 @@ class PrivateChatOnlyBot:
 
 🚀 **Let's get started!**
 
-📤 **Step 1:** Send me the **Group/Channel Link, ID, or Private Invite**:
+📤 **Step 1:** Send me the **Group/Channel Link, ID, or Private Invite** (several at once, one per line, are fine):
         """
         
         await event.reply(welcome_text, parse_mode='md')
-        self.data_manager.set_user_state(user_id, {'step': 'awaiting_group'})
+        self.conversations.set(user_id, {'step': 'awaiting_group'})
     
     async def handle_cancel(self, event):
         """Handle /cancel command"""
         user_id = event.sender_id
-        self.data_manager.clear_user_state(user_id)
+        self.conversations.clear(user_id)
+        self.albums.discard(user_id)
         await event.reply("✅ **Operation cancelled!**\n\nType /start to begin again.", parse_mode='md')
     
     async def handle_my_tasks(self, event):
         """Handle /mytasks command"""
         user_id = event.sender_id
-        tasks = self.data_manager.get_user_tasks(user_id)
+        # Workers update forward counts in storage behind the front's back
+        tasks = self.tasks.user_tasks(user_id, refresh=self.role == 'front')
         
         if not tasks:
             await event.reply("📭 **You have no active forwarding tasks!**\n\nUse /start to create one.", parse_mode='md')
@@ -499,9 +2876,16 @@ class PrivateChatOnlyBot:
             
             tasks_text += f"**Task #{task_id}** {status_emoji}\n"
             tasks_text += f"• **Target:** {target}\n"
+            preview = self.message_preview(user_id, task.get('source_msg_id'))
+            if task.get('source_msg_ids'):
+                preview = f"Album of {len(task['source_msg_ids'])} · {preview}"
+            tasks_text += f"• **Message:** {preview}\n"
             tasks_text += f"• **Interval:** {interval} hour{'s' if interval > 1 else ''}\n"
             tasks_text += f"• **Created:** {created}\n"
             tasks_text += f"• **Forwards:** {forward_count}\n"
+            delivery = TaskRegistry.delivery_summary([task])
+            if delivery:
+                tasks_text += f"• **Delivery:** {delivery}\n"
             tasks_text += f"• **Stop:** `/stoptask_{task_id}`\n\n"
         
         tasks_text += "🛑 **To stop a task:** Use `/stoptask_1` (replace 1 with task number)"
@@ -529,9 +2913,19 @@ class PrivateChatOnlyBot:
     async def handle_status(self, event):
         """Handle /status command"""
         user_id = event.sender_id
-        me = await self.client.get_me()
-        tasks = self.data_manager.get_user_tasks(user_id)
+        me = await self.get_me()
+        # Workers update forward counts in storage behind the front's back
+        tasks = self.tasks.user_tasks(user_id, refresh=self.role == 'front')
         active_tasks = sum(1 for task in tasks if task.get('status') == 'active')
+        targets = {task.get('target_chat_id') for task in tasks}
+        if self.role == 'front':
+            # Rate limiting happens in the shard workers; this process never sees it
+            throttling = "tracked by shard workers"
+        else:
+            throttled = sum(self.rate_limiter.throttled_seconds.get(chat_id, 0) for chat_id in targets)
+            flood_waits = sum(self.rate_limiter.flood_waits.get(chat_id, 0) for chat_id in targets)
+            throttling = f"{throttled:.0f}s ({flood_waits} flood waits)"
+        delivery = TaskRegistry.delivery_summary(tasks) or "No forwards yet"
         
         status_text = f"""
 🤖 **Bot Status Report**
@@ -545,6 +2939,8 @@ class PrivateChatOnlyBot:
 **Your Tasks:**
 • **Total Tasks:** {len(tasks)}
 • **Active Tasks:** {active_tasks}
+• **Throttled:** {throttling}
+• **Delivery:** {delivery}
 
 **Bot Restrictions:**
 ✅ Only works in private chats
@@ -556,6 +2952,35 @@ class PrivateChatOnlyBot:
         
         await event.reply(status_text, parse_mode='md')
     
+    async def handle_profile(self, event):
+        """Handle /profile N: profile the bot for N seconds (admins only)"""
+        if event.sender_id not in ADMIN_IDS:
+            await event.reply("❌ **This command is for bot admins only!**", parse_mode='md')
+            return
+        
+        _, _, arg = event.raw_text.partition(' ')
+        try:
+            seconds = float(arg) if arg.strip() else 30
+        except ValueError:
+            await event.reply("❌ **Usage:** `/profile 30`", parse_mode='md')
+            return
+        
+        task = self.profiler.start(seconds)
+        if task is None:
+            await event.reply("⏳ **A profile is already running!**", parse_mode='md')
+            return
+        await event.reply(f"🔬 **Profiling for {min(seconds, PROFILE_MAX_SECONDS):g}s...**", parse_mode='md')
+        task.add_done_callback(lambda done: asyncio.create_task(self.report_profile(event, done)))
+    
+    async def report_profile(self, event, task: asyncio.Task):
+        """Tell the admin where a finished profile was written"""
+        if task.cancelled():
+            return
+        if task.exception():
+            await event.reply(f"❌ **Profiling failed:** {task.exception()}", parse_mode='md')
+        else:
+            await event.reply(f"✅ **Profile written to** `{task.result()}`", parse_mode='md')
+    
     async def handle_help(self, event):
         """Handle /help command"""
         help_text = """
@@ -566,7 +2991,7 @@ class PrivateChatOnlyBot:
 **Quick Start:**
 1. **Message me privately** (not in a group)
 2. Use `/start` command
-3. Send group/channel link or ID
+3. Send group/channel links or IDs (one or many)
 4. Forward your message
 5. Choose interval (1-6 hours)
 
@@ -594,7 +3019,7 @@ class PrivateChatOnlyBot:
         user_id = event.sender_id
         
         # Get user state
-        state = self.data_manager.get_user_state(user_id)
+        state = self.conversations.get(user_id)
         
         if not state:
             # User not in setup, send minimal response
@@ -609,24 +3034,44 @@ class PrivateChatOnlyBot:
         current_step = state.get('step')
         
         if current_step == 'awaiting_group':
-            group_input = event.raw_text.strip()
-            processing_msg = await event.reply("🔍 **Verifying group access...**", parse_mode='md')
+            group_inputs = self.parse_group_inputs(event.raw_text)
+            if not group_inputs:
+                await event.reply("❌ **Invalid group link or ID!**", parse_mode='md')
+                return
+            if len(group_inputs) > MAX_SETUP_TARGETS:
+                await event.reply(f"❌ **Too many targets!** Send at most {MAX_SETUP_TARGETS} at once.", parse_mode='md')
+                return
+            
+            processing_msg = await event.reply(
+                "🔍 **Verifying group access...**" if len(group_inputs) == 1
+                else f"🔍 **Verifying access to {len(group_inputs)} groups...**",
+                parse_mode='md'
+            )
+            results = await self.verify_groups(group_inputs)
             
-            success, message, chat_id, chat_title = await self.verify_group_membership(group_input)
+            targets, report = {}, []
+            for group_input, (success, message, chat_id, chat_title) in zip(group_inputs, results):
+                if success:
+                    targets.setdefault(chat_id, chat_title or "Private Group")
+                report.append(message if len(group_inputs) == 1 else f"`{group_input}` — {message}")
             
-            if not success:
-                await processing_msg.edit(message)
+            if not targets:
+                await processing_msg.edit('\n'.join(report), parse_mode='md')
                 return
             
             state.update({
                 'step': 'awaiting_message',
-                'target_chat_id': chat_id,
-                'target_chat_title': chat_title or "Private Group"
+                'targets': [{'chat_id': chat_id, 'chat_title': title} for chat_id, title in targets.items()]
             })
-            self.data_manager.set_user_state(user_id, state)
+            self.conversations.set(user_id, state)
+            
+            if len(group_inputs) == 1:
+                summary = f"✅ **Target set to:** {next(iter(targets.values()))}"
+            else:
+                summary = f"✅ **{len(targets)} of {len(group_inputs)} targets set:**\n" + '\n'.join(report)
             
             await processing_msg.edit(
-                f"✅ **Target set to:** {chat_title or 'Private Group'}\n\n"
+                f"{summary}\n\n"
                 f"📝 **Step 2:** Forward me the message you want to auto-forward.\n\n"
                 f"💡 **Tip:** Forward it (don't copy) to preserve original sender info.",
                 parse_mode='md'
@@ -637,28 +3082,18 @@ class PrivateChatOnlyBot:
                 await event.reply("❌ **Please forward a message to me!**", parse_mode='md')
                 return
             
+            if event.message.grouped_id:
+                # handle_album() continues once the whole album is in
+                self.albums.add(user_id, event.message)
+                return
+            
             # Store message
-            message_data = self.store_message_data(event.message)
+            message_data = self.store_message_data(user_id, event.message)
+            self.source_messages.put((user_id, event.message.id), event.message)
             state['step'] = 'awaiting_interval'
             state['source_msg_id'] = event.message.id
-            self.data_manager.set_user_state(user_id, state)
-            
-            # Create buttons for interval selection
-            buttons = [
-                [Button.inline("1️⃣ 1 Hour", b"int_1"),
-                 Button.inline("2️⃣ 2 Hours", b"int_2"),
-                 Button.inline("3️⃣ 3 Hours", b"int_3")],
-                [Button.inline("4️⃣ 4 Hours", b"int_4"),
-                 Button.inline("5️⃣ 5 Hours", b"int_5"),
-                 Button.inline("6️⃣ 6 Hours", b"int_6")]
-            ]
-            
-            await event.reply(
-                f"✅ **Message received!**\n\n"
-                f"⏰ **Step 3:** Choose forwarding interval:",
-                buttons=buttons,
-                parse_mode='md'
-            )
+            self.conversations.set(user_id, state)
+            await self.ask_interval(event.reply, "Message")
         
         elif current_step == 'awaiting_interval':
             await event.reply(
@@ -666,12 +3101,49 @@ class PrivateChatOnlyBot:
                 parse_mode='md'
             )
     
+    async def handle_album(self, user_id: int, messages: list):
+        """Use a collected album as the source of the user's setup"""
+        try:
+            state = self.conversations.get(user_id)
+            if state.get('step') != 'awaiting_message':
+                return
+            
+            for message in messages:
+                self.store_message_data(user_id, message)
+                self.source_messages.put((user_id, message.id), message)
+            state['step'] = 'awaiting_interval'
+            state['source_msg_id'] = messages[0].id
+            state['source_msg_ids'] = [message.id for message in messages]
+            self.conversations.set(user_id, state)
+            await self.ask_interval(messages[-1].reply, f"Album of {len(messages)} items")
+        except Exception as e:
+            logger.error(f"Error handling album from user {user_id}: {e}", extra={'user_id': user_id})
+    
+    async def ask_interval(self, reply, received: str):
+        """Confirm the source message and offer the interval buttons through reply"""
+        # Create buttons for interval selection
+        buttons = [
+            [Button.inline("1️⃣ 1 Hour", b"int_1"),
+             Button.inline("2️⃣ 2 Hours", b"int_2"),
+             Button.inline("3️⃣ 3 Hours", b"int_3")],
+            [Button.inline("4️⃣ 4 Hours", b"int_4"),
+             Button.inline("5️⃣ 5 Hours", b"int_5"),
+             Button.inline("6️⃣ 6 Hours", b"int_6")]
+        ]
+        
+        await reply(
+            f"✅ **{received} received!**\n\n"
+            f"⏰ **Step 3:** Choose forwarding interval:",
+            buttons=buttons,
+            parse_mode='md'
+        )
+    
     async def handle_callback(self, event):
         """Handle button callbacks"""
         user_id = event.sender_id
         data = event.data.decode()
         
-        state = self.data_manager.get_user_state(user_id)
+        state = self.conversations.get(user_id)
         if not state or state.get('step') != 'awaiting_interval':
             await event.answer("Session expired. Type /start to begin again.")
             await event.delete()
@@ -681,31 +3153,41 @@ class PrivateChatOnlyBot:
             interval = int(data[4:])
             
             if 1 <= interval <= 6:
-                task_data = {
-                    'user_id': user_id,
-                    'target_chat_id': state['target_chat_id'],
-                    'target_chat_title': state['target_chat_title'],
-                    'source_msg_id': state['source_msg_id'],
-                    'interval': interval,
-                    'status': 'active'
-                }
+                # States saved before multi-target setup carry a single target
+                targets = state.get('targets') or [
+                    {'chat_id': state['target_chat_id'], 'chat_title': state['target_chat_title']}
+                ]
                 
-                task_id = self.data_manager.add_forwarding_task(user_id, task_data)
-                await self.start_forwarding_task(user_id, task_data)
-                self.data_manager.clear_user_state(user_id)
+                task_ids = []
+                for target in targets:
+                    task_data = {
+                        'user_id': user_id,
+                        'target_chat_id': target['chat_id'],
+                        'target_chat_title': target['chat_title'],
+                        'source_msg_id': state['source_msg_id'],
+                        'interval': interval,
+                        'status': 'active',
+                        **await self.target_peer(target['chat_id'])
+                    }
+                    if len(state.get('source_msg_ids') or ()) > 1:
+                        task_data['source_msg_ids'] = state['source_msg_ids']
+                    task_ids.append(self.tasks.create(user_id, task_data))
+                    await self.start_forwarding_task(user_id, task_data)
+                self.conversations.clear(user_id)
                 
+                many = len(task_ids) > 1
                 confirmation_text = f"""
 🎉 **Auto-Forwarding Setup Complete!**
 
-✅ **Target:** {state['target_chat_title']}
+✅ **Target{'s' if many else ''}:** {', '.join(target['chat_title'] for target in targets)}
 ✅ **Interval:** Every {interval} hour{'s' if interval > 1 else ''}
-✅ **Task ID:** #{task_id}
+✅ **Task ID{'s' if many else ''}:** {', '.join(f'#{task_id}' for task_id in task_ids)}
 ✅ **Status:** 🟢 **ACTIVE**
 
 📤 **Forwarding will start immediately.**
 
 📋 **View tasks:** /mytasks
-🛑 **Stop task:** `/stoptask_{task_id}`
+🛑 **Stop task:** `/stoptask_{task_ids[0]}`
                 """
                 
                 await event.edit(confirmation_text, parse_mode='md')
@@ -713,46 +3195,163 @@ class PrivateChatOnlyBot:
     # ==================== BOT LIFECYCLE ====================
     async def start(self):
         """Start the bot"""
+        # Ready before connecting; catch-up updates can arrive as soon as we are
+        if self.role != 'worker':
+            self.inbound.start()
         await self.client.start(bot_token=self.bot_token)
+        self.startup.mark('connect')
         
         # Add callback handler
-        self.client.add_event_handler(
-            self.handle_callback,
-            events.CallbackQuery()
-        )
+        if self.role != 'worker':
+            self.add_handler(
+                self.handle_callback,
+                events.CallbackQuery()
+            )
+        
+        if PROFILE_SECONDS:
+            self.profiler.start(PROFILE_SECONDS)
+        
+        # Restore in the background so updates are answered meanwhile;
+        # workers load their shard in run_shard()
+        if self.role == 'standalone':
+            self.scheduler.start()
+            self.maintenance_tasks.append(asyncio.create_task(self.load_existing_tasks()))
+        elif self.role == 'worker':
+            self.scheduler.start()
+            self.maintenance_tasks.append(asyncio.create_task(self.run_shard()))
+        
+        if self.role != 'worker':
+            self.maintenance_tasks.append(asyncio.create_task(self.conversations.run_sweeper()))
+        
+        # Write storage changes behind the event loop
+        self.maintenance_tasks.append(asyncio.create_task(self.data_manager.run_flusher()))
+        self.maintenance_tasks.append(asyncio.create_task(self.ledger.run_flusher()))
+        self.maintenance_tasks.append(asyncio.create_task(self.publish_status()))
         
-        # Load existing tasks
-        await self.load_existing_tasks()
+        self.startup.mark('handlers')
+        logger.info(f"Startup: {self.startup.report()}")
         
-        me = await self.client.get_me()
-        logger.info(f"🤖 Private Bot started as @{me.username}")
+        me = await self.get_me()
+        logger.info(f"🤖 Private Bot started as @{me.username} ({self.role})")
         
         # Keep running
         await self.client.run_until_disconnected()
     
+    async def publish_status(self):
+        """Periodically publish a status snapshot for the web interface"""
+        while True:
+            try:
+                me = await self.get_me()
+                self.status = BotStatus(
+                    username=me.username,
+                    connected=self.client.is_connected(),
+                    active_tasks=(self.tasks.count('active') if self.role == 'front'
+                                  else len(self.scheduler)),
+                    last_forward=self.last_forward_at.isoformat() if self.last_forward_at else None,
+                    scheduler_backlog=self.scheduler.backlog,
+                    updated_at=time.time()
+                )
+                ACTIVE_TASKS.set(self.status.active_tasks)
+                SCHEDULER_BACKLOG.set(self.status.scheduler_backlog)
+            except Exception as e:
+                logger.error(f"Error publishing status: {e}")
+            await asyncio.sleep(STATUS_INTERVAL)
+    
     async def load_existing_tasks(self):
-        """Load and restart existing tasks"""
-        tasks_data = self.data_manager.data.get('tasks', {})
+        """Load and restart existing tasks in chunks, resuming each one's schedule"""
+        started = time.perf_counter()
+        # Materialized so tasks added meanwhile can't disturb the iteration
+        tasks = self.tasks.with_status('active')
+        restored = overdue = 0
+        self.restoring = True
         
-        for user_id_str, tasks in tasks_data.items():
-            user_id = int(user_id_str)
-            for task in tasks:
-                if task.get('status') == 'active':
-                    try:
-                        await self.start_forwarding_task(user_id, task)
-                    except Exception as e:
-                        logger.error(f"Error restarting task {task['id']}: {e}")
+        for i in range(0, len(tasks), RESTORE_CHUNK_SIZE):
+            planned, late = self.plan_restore(tasks[i:i + RESTORE_CHUNK_SIZE], overdue)
+            planned = [
+                (user_id, task, delay) for user_id, task, delay in planned
+                if (user_id, task['id']) not in self.restore_skip
+            ]
+            self.scheduler.add_many(planned)
+            restored += len(planned)
+            overdue += late
+            # Let pending updates run between chunks
+            await asyncio.sleep(0)
+        
+        self.restoring = False
+        self.restore_skip.clear()
+        self.startup.record('restore', time.perf_counter() - started)
+        logger.info(f"Restored {restored} tasks ({overdue} overdue) in {time.perf_counter() - started:.3f}s")
+    
+    def plan_restore(self, tasks, released: int = 0) -> Tuple[List[Tuple[int, dict, float]], int]:
+        """Compute (user_id, task, delay) for tasks and how many of them are overdue;
+        released overdue tasks are already queued ahead of these"""
+        now = datetime.now()
+        restored = []
+        overdue = 0
+        
+        for user_id, task in tasks:
+            try:
+                interval = task['interval'] * 3600
+                if task.get('forward_count'):
+                    elapsed = (now - datetime.fromisoformat(task['last_forward'])).total_seconds()
+                    delay = min(interval - elapsed, interval)
+                else:
+                    # Never forwarded yet; last_forward is only the creation time
+                    delay = 0
+                
+                if delay <= 0:
+                    # Spread overdue tasks out instead of firing them all at once
+                    delay = (released + overdue) / RESTORE_RATE + random.uniform(0, RESTORE_JITTER)
+                    overdue += 1
+                restored.append((user_id, task, delay))
+            except Exception as e:
+                logger.error(f"Error restarting task {task.get('id')}: {e}")
+        
+        return restored, overdue
+    
+    async def run_shard(self):
+        """Keep this worker's shard membership and scheduled tasks in step with storage"""
+        self.shard = ShardCoordinator(self.data_manager, Path(self.session_file).stem)
+        while True:
+            try:
+                if self.shard.refresh():
+                    logger.info(f"Shard membership changed: worker {self.shard.index + 1} of {self.shard.count}")
+                self.sync_shard_tasks()
+            except Exception as e:
+                logger.error(f"Error syncing shard: {e}")
+            await asyncio.sleep(SHARD_SYNC_INTERVAL)
+    
+    def sync_shard_tasks(self):
+        """Schedule newly owned tasks and drop stopped or reassigned ones"""
+        owned = {(user_id, task['id']): (user_id, task) for user_id, task in self.shard.owned_tasks()}
+        dropped = [key for key in self.scheduler.keys() if key not in owned]
+        for key in dropped:
+            self.scheduler.cancel(*key)
+            self.tasks.untrack(*key)
+        
+        new = [pair for key, pair in owned.items() if key not in self.scheduler]
+        for user_id, task in new:
+            self.tasks.track(user_id, task)
+        added, overdue = self.plan_restore(new)
+        if added:
+            self.scheduler.add_many(added)
+        if added or dropped:
+            logger.info(f"Shard sync: {len(added)} tasks added ({overdue} overdue), {len(dropped)} dropped")
     
     async def stop(self):
         """Stop the bot gracefully"""
-        for task_id, task in self.active_tasks.items():
+        self.scheduler.stop()
+        self.inbound.stop()
+        for task in self.maintenance_tasks:
             task.cancel()
-        self.data_manager.save_data()
+        if self.shard is not None:
+            # Let the remaining workers take over our shard right away
+            self.shard.leave()
+        self.ledger.close()
+        self.data_manager.flush()
+        self.data_manager.close()
 
 # ==================== FLASK WEB SERVER FOR REPLIT ====================
-from flask import Flask, render_template_string
-
-app = Flask(__name__)
 bot_instance = None
 
 # Simple HTML template for Replit
@@ -903,23 +3502,150 @@ HTML_TEMPLATE = """
 </html>
 """
 
-@app.route('/')
-def home():
-    """Home page for Replit deployment"""
+class LandingPage:
+    """Landing page rendered once per bot username and served from memory"""
+    
+    def __init__(self, template: str):
+        self.template = template
+        self._rendered: Tuple[Optional[str], bytes] = (None, b'')
+    
+    def get(self, username: str) -> bytes:
+        # A single tuple assignment keeps username and body consistent across threads
+        rendered_for, body = self._rendered
+        if rendered_for != username:
+            body = self.template.replace('{{ bot_username }}', html.escape(username)).encode('utf-8')
+            self._rendered = (username, body)
+        return body
+
+
+landing_page = LandingPage(HTML_TEMPLATE)
+
+
+def home_page() -> Tuple[int, str, bytes]:
+    """Landing page with the bot's username from the status snapshot"""
     bot_username = "YourBotUsername"  # Will be replaced with actual username
-    if bot_instance and bot_instance.client.is_connected():
-        try:
-            me = bot_instance.client.loop.run_until_complete(bot_instance.client.get_me())
-            bot_username = me.username or "auto_forwarder_bot"
-        except:
-            pass
+    status = bot_instance.status if bot_instance else None
+    if status and status.updated_at:
+        bot_username = status.username or "auto_forwarder_bot"
+    
+    return 200, 'text/html; charset=utf-8', landing_page.get(bot_username)
+
+
+def health_check() -> Tuple[int, str, bytes]:
+    """Health report built from the status snapshot"""
+    # Reads the published snapshot only; never touches the bot's event loop
+    status = bot_instance.status if bot_instance else BotStatus()
+    age = time.time() - status.updated_at if status.updated_at else None
+    healthy = status.connected and age is not None and age < STATUS_INTERVAL * 3
+    
+    body = json.dumps({
+        "status": "healthy" if healthy else "unhealthy",
+        "timestamp": datetime.now().isoformat(),
+        "connected": status.connected,
+        "active_tasks": status.active_tasks,
+        "last_forward": status.last_forward,
+        "scheduler_backlog": status.scheduler_backlog,
+        "snapshot_age": age
+    })
+    return 200 if healthy else 503, 'application/json', body.encode('utf-8')
+
+
+def metrics_page() -> Tuple[int, str, bytes]:
+    """Prometheus metrics; with shard workers the forwarding ones are on their ports"""
+    exclude = FORWARDING_METRICS if SHARD_WORKERS else ()
+    return 200, 'text/plain; version=0.0.4', METRICS.render(exclude).encode('utf-8')
+
+
+def worker_metrics_page() -> Tuple[int, str, bytes]:
+    """Prometheus metrics of a shard worker"""
+    return 200, 'text/plain; version=0.0.4', METRICS.render().encode('utf-8')
+
+
+# Routes shared by the Flask app and the async server
+WEB_ROUTES = {
+    '/': home_page,
+    '/health': health_check,
+    '/metrics': metrics_page,
+}
+
+# Routes a shard worker serves on its own port
+WORKER_ROUTES = {
+    '/metrics': worker_metrics_page,
+}
+
+
+def create_flask_app():
+    """Flask app serving WEB_ROUTES; Flask is imported only when WEB_MODE is 'flask'"""
+    from flask import Flask, Response
+    
+    app = Flask(__name__)
+    
+    def respond(route) -> Response:
+        status, content_type, body = route()
+        return Response(body, status=status, content_type=content_type)
+    
+    @app.route('/')
+    def home():
+        """Home page for Replit deployment"""
+        return respond(home_page)
+    
+    @app.route('/health')
+    def health():
+        """Health check endpoint for monitoring"""
+        return respond(health_check)
+    
+    @app.route('/metrics')
+    def metrics():
+        """Prometheus metrics endpoint"""
+        return respond(metrics_page)
+    
+    return app
+
+# ==================== ASYNC WEB SERVER ====================
+HTTP_REQUEST_TIMEOUT = 5
+HTTP_MAX_HEADER_SIZE = 8192
+
+
+async def handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                      routes: Dict = WEB_ROUTES):
+    """Serve one GET/HEAD request for routes and close the connection"""
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), HTTP_REQUEST_TIMEOUT)
+        method, target, _ = head.split(b'\r\n', 1)[0].decode('latin-1').split(' ', 2)
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+            ConnectionError, ValueError):
+        writer.close()
+        return
+    
+    route = routes.get(target.split('?', 1)[0])
+    if method not in ('GET', 'HEAD'):
+        status, content_type, body = 405, 'text/plain', b'Method Not Allowed'
+    elif route is None:
+        status, content_type, body = 404, 'text/plain', b'Not Found'
+    else:
+        status, content_type, body = route()
     
-    return render_template_string(HTML_TEMPLATE, bot_username=bot_username)
+    header = (
+        f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: close\r\n\r\n"
+    ).encode('latin-1')
+    try:
+        writer.write(header if method == 'HEAD' else header + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
 
-@app.route('/health')
-def health():
-    """Health check endpoint for monitoring"""
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+
+async def start_web_server(port: int = WEB_PORT, routes: Dict = WEB_ROUTES) -> asyncio.AbstractServer:
+    """Serve the web interface from the running event loop"""
+    server = await asyncio.start_server(lambda reader, writer: handle_http(reader, writer, routes),
+                                        '0.0.0.0', port, limit=HTTP_MAX_HEADER_SIZE)
+    print(f"🌐 Starting async web server on port {port}")
+    return server
 
 # ==================== MAIN ENTRY POINT ====================
 async def run_bot():
@@ -930,16 +3656,27 @@ async def run_bot():
     print("🤖 PRIVATE AUTO-FORWARDER BOT")
     print("="*60)
     
-    bot_instance = PrivateChatOnlyBot(API_ID, API_HASH, BOT_TOKEN)
+    bot_instance = PrivateChatOnlyBot(API_ID, API_HASH, BOT_TOKEN,
+                                      role='front' if SHARD_WORKERS else 'standalone')
+    web_server = None
+    supervisor = None
     
     try:
+        if WEB_MODE == 'async':
+            web_server = await start_web_server()
+        if SHARD_WORKERS:
+            supervisor = ShardSupervisor()
+            bot_instance.maintenance_tasks.append(asyncio.create_task(supervisor.run()))
+        
         print(f"🔄 Starting bot with API ID: {API_ID}")
         print(f"🔐 Session file: {SESSION_FILE}")
-        print(f"💾 Data file: {DATA_FILE}")
+        print(f"💾 Data file: {SQLITE_FILE if STORAGE_BACKEND == 'sqlite' or SHARD_WORKERS else DATA_FILE}")
+        if SHARD_WORKERS:
+            print(f"🧩 Shard workers: {SHARD_WORKERS}")
         print("="*60)
         print("✅ **Private Chat Only Mode**")
         print("✅ **No Repeated Messages**")
-        print("✅ **Flask Web Interface**")
+        print(f"✅ **Web Interface:** {WEB_MODE}")
         print("="*60)
         print("🚀 Bot is starting...")
         
@@ -950,25 +3687,58 @@ async def run_bot():
         print(f"\n❌ Bot crashed: {e}")
         logger.error(f"Bot crashed: {e}", exc_info=True)
     finally:
+        if web_server is not None:
+            web_server.close()
+        if supervisor is not None:
+            supervisor.stop()
         await bot_instance.stop()
         print("\n✅ Bot stopped gracefully")
 
+async def run_worker_bot(slot: int):
+    """Run a shard worker that only forwards its share of the tasks"""
+    # Each worker needs its own session; Telethon sessions are single-process
+    session = f"{Path(SESSION_FILE).stem}.worker{slot}.session"
+    ledger_file = f"{Path(LEDGER_FILE).stem}.worker{slot}{Path(LEDGER_FILE).suffix}"
+    worker = PrivateChatOnlyBot(API_ID, API_HASH, BOT_TOKEN, role='worker', session=session,
+                                ledger_file=ledger_file)
+    
+    # ShardSupervisor.stop() terminates workers; disconnecting lets start() return
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(worker.client.disconnect()))
+    web_server = None
+    
+    try:
+        # Forwarding metrics live in this process, so it serves them itself
+        if WEB_MODE != 'off':
+            web_server = await start_web_server(WORKER_METRICS_PORT + slot, WORKER_ROUTES)
+        await worker.start()
+    except Exception as e:
+        logger.error(f"Shard worker {slot} crashed: {e}", exc_info=True)
+    finally:
+        if web_server is not None:
+            web_server.close()
+        await worker.stop()
+
+def run_worker(slot: int):
+    """Entry point of a shard worker process"""
+    # Rotation is not safe across processes, so each worker keeps its own log
+    setup_logging(f"{Path(LOG_FILE).stem}.worker{slot}.log")
+    asyncio.run(run_worker_bot(slot))
+
 def run_flask():
     """Run Flask web server"""
-    port = int(os.environ.get('PORT', 5000))
-    print(f"🌐 Starting Flask web server on port {port}")
-    app.run(host='0.0.0.0', port=port)
+    print(f"🌐 Starting Flask web server on port {WEB_PORT}")
+    create_flask_app().run(host='0.0.0.0', port=WEB_PORT)
 
 if __name__ == '__main__':
     # Create data directory if it doesn't exist
     Path(DATA_FILE).parent.mkdir(parents=True, exist_ok=True)
     
     # Run both bot and web server concurrently
-    import threading
-    
-    # Start Flask in a separate thread
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
+    # Start Flask in a separate thread; the async server starts inside run_bot
+    if WEB_MODE == 'flask':
+        flask_thread = threading.Thread(target=run_flask, daemon=True)
+        flask_thread.start()
     
     # Run the bot in main thread
     asyncio.run(run_bot())